@@ -0,0 +1,108 @@
+"""
+Benchmark for the pattern matching of step 3.
+Compares the original nested loop (every line x every pattern) with the PatternMatcher from pattern_util.py
+and checks that both return the same matches.
+
+Usage:
+    $ python3 benchmark_patterns.py                       # uses the logs in 'preprocessed_logs'
+    $ python3 benchmark_patterns.py --synthetic 200000    # no logs at hand? generate random lines
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+from step_3_build_dataset import load_pattern, compile_patterns
+
+
+def nested_loop_match(log_entries, compiled_patterns):
+    """
+    The original matching loop of step 3, kept as reference.
+    """
+    matches_list = []
+    for log_entry in log_entries:
+        for (main_category, sub_category), regex_list in compiled_patterns.items():
+            for pattern in regex_list:
+                match = pattern.search(log_entry)
+                if match:
+                    matches_list.append((main_category, sub_category, match))
+    return matches_list
+
+
+def load_log_lines(directory_path, max_files=None):
+    lines = []
+    files = sorted(f for f in os.listdir(directory_path) if f.endswith('.json'))[:max_files]
+    for filename in files:
+        with open(os.path.join(directory_path, filename), 'r', encoding='utf-8') as file:
+            for log in json.load(file):
+                lines.extend(log.get('stdout_lines', []))
+    return lines
+
+
+def synthetic_log_lines(n_lines, seed=666):
+    """
+    Random build-log-like lines, roughly 1 in 200 lines contains a known error message.
+    """
+    random.seed(seed)
+    words = ["INFO:", "Analyzing:", "target", "//src/foo:bar", "(12 packages loaded)", "Compiling", "src/foo/bar.cc;",
+             "Linking", "[1,234 / 5,678]", "ok", "changed:", "TASK", "[localhost]", "ERROR:", "Error", "remote", "cache"]
+    errors = ["FlexNet Licensing error:-15,570", "Errors while running CTest",
+              "ERROR: There was a problem ensuring netrc entries", "winrm connection error: timed out",
+              "Could not find a version that satisfies the requirement foo==1.0"]
+    lines = []
+    for _ in range(n_lines):
+        if random.random() < 0.005:
+            lines.append(random.choice(errors))
+        else:
+            lines.append(" ".join(random.choice(words) for _ in range(random.randint(3, 20))))
+    return lines
+
+
+def match_key(match_tuple):
+    main_category, sub_category, match = match_tuple
+    return main_category, sub_category, match.re.pattern, match.span(), match.groups()
+
+
+def time_it(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(configuration):
+    all_patterns = load_pattern(configuration.patterns)
+    matcher, build_time = time_it(compile_patterns, all_patterns)
+    compiled_patterns = matcher.compiled_patterns
+    if configuration.synthetic:
+        lines = synthetic_log_lines(configuration.synthetic)
+    else:
+        lines = load_log_lines(configuration.input_dir, configuration.max_files)
+    print(f"{len(lines)} log lines, {len(matcher.entries)} patterns, {len(matcher.always_run)} without required literal")
+
+    reference, reference_time = time_it(nested_loop_match, lines, compiled_patterns)
+    result, matcher_time = time_it(matcher.match_lines, lines)
+
+    if [match_key(m) for m in reference] != [match_key(m) for m in result]:
+        raise SystemExit("PatternMatcher returned different matches than the nested loop!")
+
+    regex_calls = sum(len(matcher.candidates(line)) for line in lines)
+    print(f"Matches:          {len(result)} (identical)")
+    print(f"Regex calls:      {len(lines) * len(matcher.entries)} -> {regex_calls} ({regex_calls / max(len(lines), 1):.2f} per line)")
+    print(f"Nested loop:      {reference_time:.3f}s ({len(lines) / reference_time:,.0f} lines/s)")
+    print(f"PatternMatcher:   {matcher_time:.3f}s ({len(lines) / matcher_time:,.0f} lines/s), compile + index {build_time:.3f}s")
+    print(f"Speedup:          {reference_time / matcher_time:.1f}x")
+
+
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the pattern matching of step 3")
+    parser.add_argument("--patterns", default="patterns.json", help="Patterns file")
+    parser.add_argument("--input_dir", default="preprocessed_logs", help="Directory with cropped logs")
+    parser.add_argument("--max_files", type=int, default=None, help="Only use the first n logs")
+    parser.add_argument("--synthetic", type=int, default=0, help="Generate n random log lines instead of reading logs")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configuration = parse_input_arguments()
+    main(configuration)
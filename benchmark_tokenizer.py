@@ -0,0 +1,78 @@
+"""
+Benchmark for the tokenization of the training data.
+Compares the pure Python RobertaTokenizer, called one text at a time (how CustomDataset used it), with the
+Rust-backed RobertaTokenizerFast encoding batches of texts, and checks that both return the same input ids.
+
+Usage:
+    $ python3 benchmark_tokenizer.py                        # uses the datasets in 'datasets'
+    $ python3 benchmark_tokenizer.py --tokenizer custom     # BPE of custom_tokenizer/
+    $ python3 benchmark_tokenizer.py --synthetic 2000       # no datasets at hand? generate random logs
+"""
+import argparse
+import itertools
+import os
+
+from benchmark_patterns import synthetic_log_lines, time_it
+from train_util import load_tokenizer, streaming_load_data_files
+from token_cache import TOKENIZE_BATCH_SIZE
+
+
+def load_texts(directory_path, max_texts):
+    dataset_names = sorted(f for f in os.listdir(directory_path) if f.endswith((".csv", ".parquet")))
+    examples = streaming_load_data_files(dataset_names, directory_path, columns=["log_line"])
+    return [example["log_line"] for example in itertools.islice(examples, max_texts)]
+
+
+def synthetic_texts(n_texts, lines_per_text=40):
+    lines = synthetic_log_lines(n_texts * lines_per_text)
+    return ["\n".join(lines[i:i + lines_per_text]) for i in range(0, len(lines), lines_per_text)]
+
+
+def encode_one_by_one(tokenizer, texts, max_length):
+    return [tokenizer.encode(text, add_special_tokens=True, truncation=True, max_length=max_length) for text in texts]
+
+
+def encode_batched(tokenizer, texts, max_length, batch_size=TOKENIZE_BATCH_SIZE):
+    input_ids = []
+    for start in range(0, len(texts), batch_size):
+        input_ids.extend(tokenizer(texts[start:start + batch_size], add_special_tokens=True, truncation=True, max_length=max_length)["input_ids"])
+    return input_ids
+
+
+def main(configuration):
+    if configuration.synthetic:
+        texts = synthetic_texts(configuration.synthetic)
+    else:
+        texts = load_texts(configuration.input_dir, configuration.max_texts)
+    slow_tokenizer = load_tokenizer(configuration.tokenizer, fast=False)
+    fast_tokenizer = load_tokenizer(configuration.tokenizer, fast=True)
+    print(f"{len(texts)} texts, {sum(len(text) for text in texts):,} characters, tokenizer '{configuration.tokenizer}', "
+          f"max_length {configuration.max_token_length}, TOKENIZERS_PARALLELISM={os.environ.get('TOKENIZERS_PARALLELISM', 'unset')}")
+
+    reference, slow_time = time_it(encode_one_by_one, slow_tokenizer, texts, configuration.max_token_length)
+    result, fast_time = time_it(encode_batched, fast_tokenizer, texts, configuration.max_token_length)
+
+    if reference != result:
+        differing = sum(1 for a, b in zip(reference, result) if a != b)
+        print(f"WARNING: {differing} of {len(texts)} texts are encoded differently by the fast tokenizer!")
+
+    n_tokens = sum(len(input_ids) for input_ids in result)
+    print(f"Tokens:                     {n_tokens:,}" + (" (identical)" if reference == result else ""))
+    print(f"RobertaTokenizer, 1 by 1:   {slow_time:.3f}s ({n_tokens / slow_time:,.0f} tokens/s)")
+    print(f"RobertaTokenizerFast, batch: {fast_time:.3f}s ({n_tokens / fast_time:,.0f} tokens/s)")
+    print(f"Speedup:                    {slow_time / fast_time:.1f}x")
+
+
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the slow and the fast tokenizer")
+    parser.add_argument("--tokenizer", default="roberta-base", help="'roberta-base' (or another pretrained name) or 'custom'")
+    parser.add_argument("--input_dir", default="datasets", help="Directory with the datasets of step 3")
+    parser.add_argument("--max_texts", type=int, default=2000, help="Only use the first n texts")
+    parser.add_argument("--max_token_length", type=int, default=512, help="Maximum number of tokens per text")
+    parser.add_argument("--synthetic", type=int, default=0, help="Generate n random log texts instead of reading datasets")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configuration = parse_input_arguments()
+    main(configuration)
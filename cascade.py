@@ -0,0 +1,199 @@
+"""
+Cascade classifier: the patterns of step 3 first, the model only for the logs none of them matches.
+
+    tier 1 "regex"    the compiled patterns.json (step_3_build_dataset.check_log), confidence 1.0
+    tier 2 "model"    the logs that would be "Unknown error" are predicted in batches by the trained classifier
+                      (inference_util.InferenceEngine), confidence = probability of the predicted label
+    without a model, unmatched logs stay "Unknown error" (tier "unknown")
+
+A log is the stdout of a failed task: a dict with 'stdout_lines' (a log of step 2, optionally with 'id') or plain text.
+The hit rate and a latency histogram are kept per tier (CascadeStats). The latency of a log in the model tier
+includes the pattern matching and the whole batch it was predicted in.
+
+    $ python3 cascade.py --input_dir preprocessed_logs --model_dir model --output cascade_predictions.csv
+"""
+import argparse
+import bisect
+import csv
+import itertools
+import json
+import os
+import threading
+import time
+
+from error_window import build_error_window
+from step_3_build_dataset import check_log, compile_patterns, load_pattern, PATTERNS, INPUT_DIR
+
+UNKNOWN_ERROR = "Unknown error"
+CASCADE_BATCH_SIZE = 64
+# upper bounds of the histogram buckets in ms, the last bucket is everything above
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class CascadeStats:
+    """
+    Number of logs and latency histogram (LATENCY_BUCKETS) per tier.
+    Thread-safe, the triage service updates it in its batch thread while requests read the summary.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.histograms = {}
+        self.total_ms = {}
+        self.lock = threading.Lock()
+
+    def add(self, tier, latency_ms):
+        with self.lock:
+            self.counts[tier] = self.counts.get(tier, 0) + 1
+            self.total_ms[tier] = self.total_ms.get(tier, 0) + latency_ms
+            histogram = self.histograms.setdefault(tier, [0] * (len(LATENCY_BUCKETS) + 1))
+            histogram[bisect.bisect_left(LATENCY_BUCKETS, latency_ms)] += 1
+
+    def summary(self):
+        """
+        Per tier: number of logs, share of all logs, mean latency in ms and the histogram {bucket: number of logs}.
+        """
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}ms"]
+        with self.lock:
+            total = sum(self.counts.values())
+            return {tier: {"logs": count, "hit_rate": count / total, "mean_ms": self.total_ms[tier] / count,
+                           "histogram": {label: n for label, n in zip(labels, self.histograms[tier]) if n}}
+                    for tier, count in self.counts.items()}
+
+    def report(self):
+        with self.lock:
+            total = sum(self.counts.values())
+            print(f"{total} logs")
+            for tier, count in self.counts.items():
+                print(f"  {tier:8} {count:>8} logs  {count / max(total, 1):>7.2%}  mean {self.total_ms[tier] / count:.2f} ms")
+                histogram = self.histograms[tier]
+                for index, n in enumerate(histogram):
+                    if not n:
+                        continue
+                    bucket = f"<= {LATENCY_BUCKETS[index]} ms" if index < len(LATENCY_BUCKETS) else f"> {LATENCY_BUCKETS[-1]} ms"
+                    print(f"    {bucket:>12} {n:>8}  {'#' * max(1, round(40 * n / count))}")
+
+
+class CascadeClassifier:
+    """
+    Classifies logs with the patterns first and with the engine (optional) for the rest, see the module docstring.
+    """
+    def __init__(self, matcher, engine=None, batch_size=CASCADE_BATCH_SIZE):
+        self.matcher = matcher
+        self.engine = engine
+        self.batch_size = batch_size
+        self.stats = CascadeStats()
+
+    @staticmethod
+    def log_lines(log):
+        if isinstance(log, dict):
+            return log.get('stdout_lines', [])
+        return log.split("\n")
+
+    def classify_regex(self, log):
+        """
+        Returns the result of the patterns for a single log, None if no pattern matches.
+        """
+        lines = self.log_lines(log)
+        matches_list = check_log(lines, "\n".join(lines), self.matcher)
+        if not matches_list:
+            return None
+        # the last match is closest to where the task failed, the other categories are returned as well
+        main_category, sub_category, _, match_lines = matches_list[-1]
+        return {"prediction": main_category, "sub_category": sub_category, "confidence": 1.0, "tier": "regex",
+                "match_lines": match_lines, "categories": sorted({match[0] for match in matches_list})}
+
+    def classify(self, logs):
+        """
+        Returns the results of the logs (list of dicts: prediction, sub_category, confidence, tier, ...), in the order of the logs.
+        """
+        results = []
+        unknown = []
+        regex_ms = []
+        for log in logs:
+            start_time = time.perf_counter()
+            result = self.classify_regex(log)
+            regex_ms.append((time.perf_counter() - start_time) * 1000)
+            if result is None:
+                unknown.append(len(results))
+                result = {"prediction": UNKNOWN_ERROR, "sub_category": UNKNOWN_ERROR, "confidence": 1.0, "tier": "unknown",
+                          "match_lines": "", "categories": []}
+            else:
+                self.stats.add("regex", regex_ms[-1])
+            results.append(result)
+
+        if self.engine is None:
+            for index in unknown:
+                self.stats.add("unknown", regex_ms[index])
+            return results
+        for start in range(0, len(unknown), self.batch_size):
+            batch = unknown[start:start + self.batch_size]
+            texts = ["\n".join(self.log_lines(logs[index])) for index in batch]
+            start_time = time.perf_counter()
+            if self.engine.error_window:
+                # no matched lines -> the last lines of the log
+                texts = [build_error_window(text, [], self.engine.tokenizer, self.engine.max_token_length) for text in texts]
+            predictions = list(self.engine.predict(texts))
+            batch_ms = (time.perf_counter() - start_time) * 1000
+            for index, top in zip(batch, predictions):
+                label, probability = top[0]
+                results[index].update({"prediction": label, "sub_category": "", "confidence": probability, "tier": "model",
+                                       "top_k": top})
+                self.stats.add("model", regex_ms[index] + batch_ms)
+        return results
+
+
+def read_logs(dir_path):
+    """
+    Yields (file name, log) of all logs of step 2 in dir_path (JSON files with a list of {'id', 'stdout_lines'}).
+    """
+    for file_name in sorted(os.listdir(dir_path)):
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(dir_path, file_name), "r", encoding="utf-8") as file:
+                logs = json.load(file)
+        except json.JSONDecodeError:
+            print(f"Invalid JSON in {file_name}")
+            continue
+        for log in logs if isinstance(logs, list) else [logs]:
+            yield file_name, log
+
+
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Classifies the logs of step 2 with the patterns first and the model for the rest")
+    parser.add_argument("--input_dir", default=INPUT_DIR, help="Directory with the logs of step 2")
+    parser.add_argument("--patterns", default=PATTERNS, help="Patterns file")
+    parser.add_argument("--model_dir", default=None, help="Directory of the model saved by train.py (none: patterns only)")
+    parser.add_argument("--quantized", action="store_true", help="Use the int8 model of quantize_model.py (CPU)")
+    parser.add_argument("--output", default="cascade_predictions.csv", help="CSV file for the predictions")
+    parser.add_argument("--batch_size", type=int, default=CASCADE_BATCH_SIZE, help="Logs per batch of the model")
+    parser.add_argument("--max_token_length", type=int, default=512, help="Maximum number of tokens per log")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of torch (default: torch default)")
+    parser.add_argument("--error_window", action="store_true", help="Give the model the last lines of long logs instead of the first")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configuration = parse_input_arguments()
+    matcher = compile_patterns(load_pattern(configuration.patterns))
+    engine = None
+    if configuration.model_dir is not None:
+        import inference_util
+        model, tokenizer, label_mapping = inference_util.load_classifier(configuration.model_dir, quantized=configuration.quantized)
+        engine = inference_util.InferenceEngine(model, tokenizer, label_mapping, batch_size=configuration.batch_size,
+                                                max_token_length=configuration.max_token_length, top_k=1,
+                                                num_threads=configuration.num_threads, error_window=configuration.error_window,
+                                                device="cpu" if configuration.quantized else None)
+    cascade = CascadeClassifier(matcher, engine, configuration.batch_size)
+
+    with open(configuration.output, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["source", "task_id", "tier", "prediction", "sub_category", "confidence"])
+        logs = read_logs(configuration.input_dir)
+        # blocks of logs, so the unknown logs of a block fill the batches of the model
+        while block := list(itertools.islice(logs, configuration.batch_size * 16)):
+            for (file_name, log), result in zip(block, cascade.classify([log for _, log in block])):
+                writer.writerow([file_name, log.get('id', ''), result["tier"], result["prediction"], result["sub_category"],
+                                 f"{result['confidence']:.4f}"])
+    print(f"Saved predictions to {configuration.output}")
+    cascade.stats.report()
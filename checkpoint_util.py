@@ -0,0 +1,122 @@
+"""
+Checkpoints for train_util.train_model, so a killed training run can be resumed instead of starting over.
+
+A checkpoint holds the state of the model, optimizer and scheduler, the RNG states (python, numpy, torch) and the
+position in the data stream (epoch and number of batches done in it, the order of the batches is fixed per epoch).
+Saving is asynchronous: the state is copied in memory and written by a background thread while training goes on.
+Checkpoints are written to a '.part' file and renamed when complete, so a crash while saving never leaves a broken
+'checkpoint-<step>.pt' behind. Only the last keep_last checkpoints are kept. A checkpoint also holds a fingerprint of the
+datasets and settings of the run (train_util.run_fingerprint) and whether the run is finished ('complete').
+"""
+import os
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+CHECKPOINT_DIR = 'checkpoints'
+_CHECKPOINT_FILE = re.compile(r"checkpoint-(\d+)\.pt$")
+
+
+def _detached_copy(obj):
+    """
+    Copy of a (nested) state dict with all tensors cloned to the CPU, so training can go on changing the originals.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _detached_copy(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_detached_copy(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointManager:
+    def __init__(self, directory=CHECKPOINT_DIR, keep_last=3):
+        self.directory = directory
+        self.keep_last = keep_last
+        # one writer thread, at most one checkpoint is written (and held in memory) at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        os.makedirs(directory, exist_ok=True)
+
+    def checkpoints(self):
+        """
+        Returns the paths of the complete checkpoints, oldest first.
+        """
+        steps = []
+        for file in os.listdir(self.directory):
+            match = _CHECKPOINT_FILE.match(file)
+            if match:
+                steps.append((int(match.group(1)), os.path.join(self.directory, file)))
+        return [path for _, path in sorted(steps)]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def clear(self):
+        """
+        Removes all checkpoints (e.g. of a finished run).
+        """
+        self.wait()
+        for path in self.checkpoints():
+            os.remove(path)
+
+    def save(self, step, state):
+        """
+        Copies the state and writes it in the background as 'checkpoint-<step>.pt'.
+        """
+        self.wait()
+        snapshot = _detached_copy(state)
+        self.pending = self.executor.submit(self._write, step, snapshot)
+
+    def _write(self, step, snapshot):
+        path = os.path.join(self.directory, f"checkpoint-{step:08d}.pt")
+        with open(path + ".part", "wb") as file:
+            torch.save(snapshot, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".part", path)
+        for old in self.checkpoints()[:-self.keep_last]:
+            os.remove(old)
+        print(f"Saved checkpoint {path}")
+
+    def wait(self):
+        """
+        Waits until the checkpoint that is being written is on disk (raises if writing it failed).
+        """
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def load(self, path=None):
+        """
+        Loads the given (default: latest) checkpoint, None if there is none.
+        """
+        path = path or self.latest()
+        if path is None:
+            return None
+        print(f"Loading checkpoint {path}")
+        return torch.load(path, map_location="cpu", weights_only=False)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
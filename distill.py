@@ -0,0 +1,93 @@
+"""
+Distills a trained classifier (teacher, model/ of train.py) into a smaller student (student_model/).
+
+The student learns from the temperature-softened logits of the teacher and from the labels (train_util.distillation_loss).
+It is either a smaller pretrained model (--student distilroberta-base, 6 layers) or the first --num_hidden_layers layers
+of roberta-base. Both use the tokenizer of the teacher, so the teacher and the student see the same input ids.
+Afterwards teacher and student are compared on the test split (macro F1, latency, throughput on the CPU).
+
+    $ python3 distill.py --student distilroberta-base
+    $ python3 distill.py --student roberta-base --num_hidden_layers 4
+    $ python3 test.py --model_dir student_model
+"""
+import argparse
+import itertools
+import warnings
+
+import numpy as np
+import train_util
+import inference_util
+
+from sklearn.metrics import f1_score
+from transformers import logging as transformers_logging
+
+# Suppress warnings
+warnings.filterwarnings('ignore', category=FutureWarning)
+transformers_logging.set_verbosity_error()
+
+OUTPUT_DIR = "student_model"
+
+config = {
+    "learning_rate": 5e-5,              # the student starts (partly) untrained, higher than for fine-tuning the teacher
+    "weight_decay": 0.01,
+    "n_epochs": 3,
+    "batch_size": 16,
+    "checkpoint_dir": "student_checkpoints",    # not the checkpoints of the teacher
+    "checkpoint_every": 1000,
+    "keep_checkpoints": 3,
+    "accumulation_steps": 1,
+    "precision": "fp32",
+    "distillation_temperature": 2.0,
+    "distillation_alpha": 0.5           # weight of the teacher, 1 - alpha of the labels
+}
+
+
+def compare(models, tokenizer, label_mapping, dataset_names, dir_path, max_examples, n_latency):
+    """
+    Prints macro F1, latency of a single example and throughput of every (name, model) on the CPU.
+    """
+    results = {}
+    for name, model in models:
+        engine = inference_util.InferenceEngine(model, tokenizer, label_mapping, device="cpu")
+        examples = list(itertools.islice(engine.read_examples(dataset_names, dir_path), max_examples))
+        texts = [text for _, _, text in examples]
+        labels = [example.get("main_category", "") for _, example, _ in examples]
+        predictions, latencies, throughput = inference_util.benchmark_engine(engine, texts, n_latency)
+        labelled = [index for index, label in enumerate(labels) if label in label_mapping]
+        macro_f1 = f1_score([labels[i] for i in labelled], [predictions[i] for i in labelled], average="macro", zero_division=0) if labelled else float("nan")
+        results[name] = (macro_f1, np.percentile(latencies, 50), throughput)
+    print(f"{'':10}{'macro F1':>10}{'p50 ms':>9}{'ex/s':>9}{'speedup':>9}")
+    for name, (macro_f1, latency, throughput) in results.items():
+        print(f"{name:10}{macro_f1:>10.4f}{latency:>9.2f}{throughput:>9.1f}{throughput / results['teacher'][2]:>9.2f}")
+
+
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Distills the trained classifier into a smaller student")
+    parser.add_argument("--teacher_dir", default=inference_util.MODEL_DIR, help="Directory of the teacher saved by train.py")
+    parser.add_argument("--student", default="distilroberta-base", help="Pretrained model the student starts from")
+    parser.add_argument("--num_hidden_layers", type=int, default=None, help="Keep only the first layers of the student model")
+    parser.add_argument("--output_dir", default=OUTPUT_DIR, help="Directory for the student")
+    parser.add_argument("--max_examples", type=int, default=1000, help="Number of test examples to compare teacher and student on")
+    parser.add_argument("--n_latency", type=int, default=100, help="Number of examples to measure the single example latency on")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configuration = parse_input_arguments()
+    teacher, tokenizer, label_mapping = inference_util.load_classifier(configuration.teacher_dir)
+    data_module = train_util.CustomDataModule(train_util.train_dataset_names, train_util.test_dataset_names, train_util.DIR,
+                                              batch_size=config["batch_size"], tokenizer_name=configuration.teacher_dir,
+                                              mapping_file=f"{configuration.teacher_dir}/label_mapping.json")
+    data_module.setup()
+
+    student = train_util.RoBERTaClassifier(n_labels=len(label_mapping), vocab_size=train_util.tokenizer_vocab_size(tokenizer),
+                                           model_name=configuration.student, num_hidden_layers=configuration.num_hidden_layers)
+    print(f"Teacher: {teacher.roberta.config.num_hidden_layers} layers, {sum(p.numel() for p in teacher.parameters()) / 1e6:.1f}M parameters")
+    print(f"Student: {student.roberta.config.num_hidden_layers} layers, {sum(p.numel() for p in student.parameters()) / 1e6:.1f}M parameters")
+
+    trained_student = train_util.train_model(student, data_module, config, teacher=teacher)
+    inference_util.save_classifier(trained_student, tokenizer, configuration.output_dir, f"{configuration.teacher_dir}/label_mapping.json")
+    print("Saved student to %s" % configuration.output_dir)
+
+    compare([("teacher", teacher), ("student", trained_student)], tokenizer, label_mapping, train_util.test_dataset_names,
+            train_util.DIR, configuration.max_examples, configuration.n_latency)
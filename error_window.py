@@ -0,0 +1,81 @@
+"""
+Token-budgeted window around the error of a log text.
+
+Truncating the tokenized log to max_length keeps the head of the log, but the failure usually sits near the lines
+step 3 matched (column 'match_lines'). build_error_window keeps the matched lines and grows the window around them
+line by line (the lines closest to a match first) until the token budget is used up. Skipped parts are replaced
+by a '...' line. Logs without matched lines ('Unknown error') keep their last lines, where the failure usually is.
+
+    log text (3000 lines), match_lines "1711 1712", budget 512 tokens
+        -> "...\n<lines 1690-1735>\n..."
+"""
+GAP_MARKER = "..."
+
+
+def parse_match_lines(match_lines):
+    """
+    "17 18" (column of step 3) -> [17, 18], empty/missing -> []
+    """
+    if not match_lines or not isinstance(match_lines, str):
+        return []
+    return [int(line) for line in match_lines.split()]
+
+
+def build_error_window(text, match_lines, tokenizer, max_tokens):
+    """
+    Returns the part of text around the match_lines (list of line numbers) that fits into max_tokens tokens
+    (incl. the special tokens of the tokenizer). Texts that fit completely are returned unchanged.
+    """
+    budget = max_tokens - tokenizer.num_special_tokens_to_add()
+    if len(text.encode("utf-8")) <= budget:
+        # a byte-level BPE token covers at least one byte -> fits for sure, no need to tokenize
+        return text
+    lines = text.split("\n")
+    centers = sorted({line for line in match_lines if 0 <= line < len(lines)}) or [len(lines) - 1]
+
+    costs = {}
+
+    def cost(candidates):
+        # tokens of a line incl. its newline, the lines of one step are tokenized in a single batch
+        missing = [line for line in candidates if line not in costs]
+        if missing:
+            encoded = tokenizer([lines[line] + "\n" for line in missing], add_special_tokens=False)["input_ids"]
+            costs.update(zip(missing, map(len, encoded)))
+        return [costs[line] for line in candidates]
+
+    # every gap costs a marker line, at most one before, one after and one between two neighbouring centers
+    used = len(tokenizer(GAP_MARKER + "\n", add_special_tokens=False)["input_ids"]) * (len(centers) + 1)
+    selected = set()
+    distance = 0
+    while len(selected) < len(lines):
+        candidates = []
+        for center in centers:
+            for line in (center - distance, center + distance):
+                if 0 <= line < len(lines) and line not in selected and line not in candidates:
+                    candidates.append(line)
+        if not candidates and distance > len(lines):
+            break
+        full = False
+        for line, line_cost in zip(candidates, cost(candidates)):
+            # a matched line that does not fit alone is kept anyway (cut by the truncation of the tokenizer)
+            if used + line_cost > budget and selected:
+                full = True
+                break
+            selected.add(line)
+            used += line_cost
+        if full:
+            break
+        distance += 1
+
+    if len(selected) == len(lines):
+        return text
+    window = []
+    previous = -1
+    for line in sorted(selected):
+        if line != previous + 1:
+            window.append(GAP_MARKER)
+        window.append(lines[line])
+        previous = line
+    if previous != len(lines) - 1:
+        window.append(GAP_MARKER)
+    return "\n".join(window)
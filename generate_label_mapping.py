@@ -1,43 +1,80 @@
-import random
+import argparse
 import os
 import json
 import tqdm
+import pandas as pd
+import pyarrow.parquet as pq
 
-from os import listdir
-from datasets import load_dataset
-from transformers import RobertaTokenizer
 
-
-LIST_OF_DATASETS = listdir("/home/q524745/bachelor_thesis/datasets")
 DIR = "datasets"
-TRAIN_PERCENTAGE = 0.8
-TEST_PERCENTAGE = 0.2
+LABEL_MAPPING = "label_mapping.json"
 
-random.shuffle(LIST_OF_DATASETS)
 
-SPLIT_CUTOFF = int(len(LIST_OF_DATASETS) * TRAIN_PERCENTAGE)
+class LabelMapping:
+    """
+    Label vocabulary (main_category -> id) that grows with the data.
+    Existing labels keep their id, new labels are appended with the next free id, so a model trained on
+    an older label_mapping.json stays valid. Step 3 updates it with the categories of every log it saves,
+    label_mapping.json is only rewritten when a new label shows up.
+    """
+    def __init__(self, path=LABEL_MAPPING):
+        self.path = path
+        self.mapping = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                self.mapping = json.load(file)
 
-train_dataset_names  = LIST_OF_DATASETS[:SPLIT_CUTOFF]
-test_dataset_names = LIST_OF_DATASETS[SPLIT_CUTOFF:]
+    def update(self, labels):
+        """
+        Adds the labels that are not known yet. Returns the list of new labels.
+        """
+        new_labels = sorted(set(labels) - set(self.mapping))
+        if not new_labels:
+            return new_labels
+        next_id = max(self.mapping.values(), default=-1) + 1
+        for idx, label in enumerate(new_labels, start=next_id):
+            self.mapping[label] = idx
+        self.save()
+        return new_labels
 
-tokenizer = RobertaTokenizer.from_pretrained("roberta-base")
+    def save(self):
+        with open(self.path + ".part", "w") as file:
+            json.dump(self.mapping, file)
+        os.replace(self.path + ".part", self.path)
 
-def build_label_mapping(dataset_names, dir_path, save_path="label_mapping.json"):
-    unique_labels = set()
-    for file_name in tqdm.tqdm(dataset_names):
-        filepath = os.path.join(dir_path, file_name)
-        dataset = load_dataset("csv", data_files=filepath, split="train", streaming=True)
-        for example in dataset:
-            if "main_category" in example: 
-                unique_labels.add(example["main_category"])
-    print(f"Unique labels: {len(unique_labels)}")
-    label_mapping = {label:idx for idx, label in enumerate(sorted(unique_labels))}
 
-    with open(save_path, "w") as file:
-        json.dump(label_mapping, file)
+def read_labels(file_name, dir_path):
+    """
+    Returns the distinct main_category values of one dataset (CSV of a log or Parquet shard).
+    """
+    filepath = os.path.join(dir_path, file_name)
+    if file_name.endswith(".parquet"):
+        # only the (dictionary encoded) main_category column is read
+        table = pq.read_table(filepath, columns=["main_category"])
+        return set(table.column("main_category").unique().to_pylist())
+    dataset_df = pd.read_csv(filepath, usecols=lambda column: column == "main_category")
+    return set(dataset_df["main_category"].dropna()) if "main_category" in dataset_df else set()
 
-    return label_mapping
 
-labels = build_label_mapping(train_dataset_names, DIR, save_path="label_mapping.json")
+def build_label_mapping(dataset_names, dir_path, save_path=LABEL_MAPPING):
+    """
+    Scans the given datasets and adds their labels to the mapping in save_path (ids of known labels do not change).
+    Only needed for datasets that were built before step 3 kept the mapping up to date.
+    """
+    label_mapping = LabelMapping(save_path)
+    unique_labels = set()
+    for file_name in tqdm.tqdm(dataset_names):
+        unique_labels.update(read_labels(file_name, dir_path))
+    new_labels = label_mapping.update(unique_labels)
+    print(f"Unique labels: {len(unique_labels)}, new: {len(new_labels)}, total: {len(label_mapping.mapping)}")
+    return label_mapping.mapping
+
 
-print("done")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adds the labels of existing datasets to label_mapping.json")
+    parser.add_argument("--dataset_dir", default=DIR, help="Directory with the datasets (CSV or Parquet)")
+    parser.add_argument("--save_path", default=LABEL_MAPPING, help="Label mapping file")
+    args = parser.parse_args()
+    dataset_names = [f for f in os.listdir(args.dataset_dir) if f.endswith((".csv", ".parquet"))]
+    build_label_mapping(dataset_names, args.dataset_dir, save_path=args.save_path)
+    print("done")
@@ -0,0 +1,192 @@
+"""
+Batch inference with a trained RoBERTaClassifier (saved by train.py in model/).
+
+The datasets (CSV or Parquet of step 3) are streamed in chunks. Every chunk is tokenized in one call, sorted by
+length and cut into batches, so every batch is only padded to its longest example (see train_util.collate_batch).
+The forward passes run under torch.inference_mode. The predictions are written in the order of the input rows:
+    source, task_id, label (main_category of the row, if there is one), prediction, top_1_label, top_1_probability, ...
+
+    model/
+        model.pt              state dict of the classifier (or a checkpoint of train_model, see load_classifier)
+        config.json           config of the roberta model
+        label_mapping.json    main_category -> id the model was trained with
+        tokenizer files       written by tokenizer.save_pretrained
+        model_int8.pt         dynamic int8 quantized classifier for CPU inference (quantize_model.py)
+"""
+import csv
+import itertools
+import os
+import shutil
+import time
+
+import torch
+import torch.nn as nn
+from transformers import RobertaTokenizerFast
+
+from train_util import RoBERTaClassifier, collate_batch, load_label_mapping, streaming_load_data_files
+from error_window import build_error_window, parse_match_lines
+
+MODEL_DIR = "model"
+QUANTIZED_MODEL = "model_int8.pt"
+INFERENCE_BATCH_SIZE = 64
+CHUNK_BATCHES = 16
+
+
+def save_classifier(model, tokenizer, output_dir=MODEL_DIR, label_mapping_path="label_mapping.json"):
+    """
+    Saves a trained classifier in the layout above (model.pt, config.json, tokenizer, label_mapping.json).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
+    torch.save(model.state_dict(), os.path.join(output_dir, "model.pt"))
+    # config of the (resized) roberta model, so load_classifier can build the model without downloading the weights
+    model.roberta.config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    if os.path.abspath(label_mapping_path) != os.path.abspath(os.path.join(output_dir, "label_mapping.json")):
+        shutil.copy(label_mapping_path, os.path.join(output_dir, "label_mapping.json"))
+
+
+def quantize_classifier(model):
+    """
+    Dynamic int8 quantization of all Linear layers (roberta encoder and pooler, classifier): the weights are stored
+    as int8, the activations are quantized on the fly for every batch. The embeddings stay in float32. CPU only.
+    """
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def export_quantized(model_dir=MODEL_DIR, checkpoint_path=None):
+    """
+    Quantizes the model saved in model_dir and saves it as model_dir/model_int8.pt. Returns (quantized model, path).
+    """
+    model, _, _ = load_classifier(model_dir, checkpoint_path)
+    quantized = quantize_classifier(model)
+    path = os.path.join(model_dir, QUANTIZED_MODEL)
+    torch.save(quantized.state_dict(), path)
+    return quantized, path
+
+
+def load_classifier(model_dir=MODEL_DIR, checkpoint_path=None, quantized=False):
+    """
+    Returns (model, tokenizer, label_mapping) saved in model_dir. checkpoint_path loads the weights of a checkpoint
+    of train_model (checkpoints/checkpoint-<step>.pt) instead of model_dir/model.pt.
+    quantized=True loads the int8 model of export_quantized (model_dir/model_int8.pt) instead.
+    """
+    label_mapping = load_label_mapping(os.path.join(model_dir, "label_mapping.json"))
+    tokenizer = RobertaTokenizerFast.from_pretrained(model_dir)
+    # the architecture comes from config.json, the weights from the state dict -> nothing is downloaded
+    model = RoBERTaClassifier(n_labels=len(label_mapping), model_name=model_dir, pretrained=False)
+    if quantized:
+        # the quantized state dict (packed int8 weights) only fits into a model with quantized Linear layers
+        model = quantize_classifier(model)
+        state = torch.load(os.path.join(model_dir, QUANTIZED_MODEL), map_location="cpu", weights_only=False)
+        model.load_state_dict(state)
+        return model, tokenizer, label_mapping
+    state = torch.load(checkpoint_path or os.path.join(model_dir, "model.pt"), map_location="cpu", weights_only=False)
+    # a checkpoint holds the state of optimizer, scheduler, ... next to the model
+    model.load_state_dict(state["model"] if "model" in state and "optimizer" in state else state)
+    return model, tokenizer, label_mapping
+
+
+class InferenceEngine:
+    """
+    Predicts the main_category of log texts in batches of batch_size.
+    num_threads sets the number of threads torch uses inside of an operation (intra-op) on the CPU, None keeps the default.
+    A quantized model (quantize_classifier) has to run on the CPU (device="cpu").
+    """
+    def __init__(self, model, tokenizer, label_mapping, batch_size=INFERENCE_BATCH_SIZE, max_token_length=512, top_k=3,
+                 num_threads=None, device=None, error_window=False):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.model = model.to(self.device).eval()
+        self.tokenizer = tokenizer
+        self.id_to_label = {idx: label for label, idx in label_mapping.items()}
+        self.batch_size = batch_size
+        self.max_token_length = max_token_length
+        self.top_k = min(top_k, len(label_mapping))
+        self.error_window = error_window
+
+    def predict_batch(self, input_ids):
+        """
+        Returns the top_k (label ids, probabilities) of every example of a batch of input ids.
+        """
+        batch = collate_batch([(ids, 0, 1) for ids in input_ids], self.tokenizer.pad_token_id)
+        with torch.inference_mode():
+            _, logits = self.model(batch["input_ids"].to(self.device), batch["attention_mask"].to(self.device))
+            probabilities, label_ids = torch.softmax(logits.float(), dim=-1).topk(self.top_k, dim=-1)
+        return label_ids.cpu().tolist(), probabilities.cpu().tolist()
+
+    def predict(self, texts):
+        """
+        Yields the top_k [(label, probability), ...] of every text, in the order of the texts.
+        """
+        texts = iter(texts)
+        while chunk := list(itertools.islice(texts, self.batch_size * CHUNK_BATCHES)):
+            encoded = self.tokenizer(chunk, add_special_tokens=True, truncation=True, max_length=self.max_token_length)["input_ids"]
+            # batches of examples with similar length need (almost) no padding
+            order = sorted(range(len(encoded)), key=lambda index: len(encoded[index]))
+            results = [None] * len(encoded)
+            for start in range(0, len(order), self.batch_size):
+                indices = order[start:start + self.batch_size]
+                label_ids, probabilities = self.predict_batch([encoded[index] for index in indices])
+                for index, ids, probs in zip(indices, label_ids, probabilities):
+                    results[index] = [(self.id_to_label.get(idx, str(idx)), prob) for idx, prob in zip(ids, probs)]
+            yield from results
+
+    def read_examples(self, dataset_names, dir_path, text_store=None):
+        """
+        Yields (file name, row, text) of all rows of the datasets, the text as the model gets it (error window).
+        With a text_store, rows that reference their text by 'text_id' (step 3 with --dedupe_text) are resolved.
+        """
+        columns = ["task_id", "log_line", "text_id", "main_category", "match_lines"]
+        for file_name in dataset_names:
+            for example in streaming_load_data_files([file_name], dir_path, columns):
+                text = example.get("log_line")
+                if text is None and text_store is not None and "text_id" in example:
+                    text = text_store.get(example["text_id"])
+                if text is None:
+                    print(f"Missing text in example of {file_name}: {example}")
+                    continue
+                if self.error_window:
+                    text = build_error_window(text, parse_match_lines(example.get("match_lines")), self.tokenizer, self.max_token_length)
+                yield file_name, example, text
+
+    def predict_datasets(self, dataset_names, dir_path, output_path, text_store=None):
+        """
+        Predicts all rows of the datasets (see read_examples) and writes them to the CSV output_path.
+        Returns (number of examples, seconds).
+        """
+        header = ["source", "task_id", "label", "prediction"]
+        for k in range(1, self.top_k + 1):
+            header += [f"top_{k}_label", f"top_{k}_probability"]
+        n_examples = 0
+        start_time = time.perf_counter()
+        with open(output_path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            examples = self.read_examples(dataset_names, dir_path, text_store)
+            while chunk := list(itertools.islice(examples, self.batch_size * CHUNK_BATCHES)):
+                for (file_name, example, _), top in zip(chunk, self.predict(text for _, _, text in chunk)):
+                    row = [file_name, example.get("task_id", ""), example.get("main_category", ""), top[0][0]]
+                    for label, probability in top:
+                        row += [label, f"{probability:.4f}"]
+                    writer.writerow(row)
+                n_examples += len(chunk)
+        return n_examples, time.perf_counter() - start_time
+
+
+def benchmark_engine(engine, texts, n_latency):
+    """
+    Returns (predicted labels, latencies of single examples in ms, examples/s in batches of engine.batch_size).
+    """
+    # warm up (memory allocation, packing of the int8 weights)
+    list(engine.predict(texts[:engine.batch_size]))
+    latencies = []
+    for text in texts[:n_latency]:
+        start_time = time.perf_counter()
+        next(engine.predict([text]))
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    start_time = time.perf_counter()
+    predictions = [top[0][0] for top in engine.predict(texts)]
+    throughput = len(texts) / (time.perf_counter() - start_time)
+    return predictions, latencies, throughput
@@ -0,0 +1,313 @@
+"""
+Pattern matching engine for step 3 (building the dataset).
+
+The naive approach runs every compiled pattern of patterns.json against every log line,
+which means a few hundred re.search calls per line. Nearly all of the patterns contain a
+literal that has to be present for the pattern to match at all (e.g. "FlexNet Licensing error:").
+When the patterns are compiled, these required literals are extracted into an index
+(literal -> patterns). At match time a single multi-literal scan over the line finds all
+literals that occur in it, and only the patterns behind those literals are run.
+Patterns without a usable literal are always run.
+
+match_line/match_lines return exactly the same (main_category, sub_category, match) tuples,
+in the same order, as looping over all patterns for every line.
+
+Some patterns span several lines (they contain a '\\n' or use (?s)). These do not fit into a single
+line, so match_log goes over the joined stdout of a task once: single-line patterns are still run per
+line, multi-line patterns are only run on a bounded window of lines around the lines that contain
+their literals.
+"""
+import bisect
+import itertools
+import re
+
+try:
+    from re import _parser as sre_parse     # python >= 3.11
+except ImportError:
+    import sre_parse
+
+# Literals shorter than this occur in almost every line and would not filter anything
+MIN_LITERAL_LENGTH = 3
+# Multi-line patterns are searched in lines [hit - MULTILINE_WINDOW, hit + MULTILINE_WINDOW] around a line with their literal
+MULTILINE_WINDOW = 25
+
+_REPEATS = tuple(op for op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)) if op is not None)
+
+
+def _best(candidates):
+    """
+    Picks the most selective set of literals: the one whose shortest literal is the longest.
+    """
+    candidates = [c for c in candidates if c]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda c: (min(len(literal) for literal in c), -len(c)))
+
+
+def _required_literals(items):
+    """
+    Returns a set of literals of which at least one has to occur in every match of the parsed
+    (sub)pattern, or None if no such set exists.
+    """
+    candidates = []
+    current = ""
+
+    def close_run():
+        nonlocal current
+        if len(current) >= MIN_LITERAL_LENGTH:
+            candidates.append(frozenset([current]))
+        current = ""
+
+    def walk(items):
+        nonlocal current
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                current += chr(av)
+            elif op is sre_parse.AT:
+                # anchors (^, $, \b) have no width, the literal run continues
+                continue
+            elif op is sre_parse.SUBPATTERN and not av[1] and not av[2]:
+                # plain group -> its content is part of the same sequence
+                walk(av[3])
+            else:
+                close_run()
+                if op is sre_parse.SUBPATTERN:
+                    continue    # group with changed flags (e.g. (?i:...)), skip
+                if op in _REPEATS and av[0] >= 1:
+                    candidates.append(_required_literals(av[2]))
+                elif op is sre_parse.ASSERT or op is getattr(sre_parse, "ATOMIC_GROUP", None):
+                    candidates.append(_required_literals(av[1] if op is sre_parse.ASSERT else av))
+                elif op is sre_parse.BRANCH:
+                    branches = [_required_literals(branch) for branch in av[1]]
+                    if all(branches):
+                        candidates.append(frozenset().union(*branches))
+
+    walk(items)
+    close_run()
+    return _best(candidates)
+
+
+def required_literals(pattern):
+    """
+    Returns a frozenset of literals of which at least one has to be contained in every string
+    the compiled pattern can match, e.g.
+        'FlexNet Licensing error:.*\\n.*'            -> {'FlexNet Licensing error:'}
+        '(Data could not be sent|Make sure).+$'      -> {'Data could not be sent', 'Make sure'}
+        '^(.+\\n)+'                                  -> None (always has to be run)
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+    return _required_literals(sre_parse.parse(pattern.pattern, pattern.flags))
+
+
+def _contains_newline(node):
+    if isinstance(node, sre_parse.SubPattern):
+        node = node.data
+    if isinstance(node, (list, tuple)):
+        if len(node) == 2 and node[0] is sre_parse.LITERAL:
+            return node[1] == ord("\n")
+        return any(_contains_newline(child) for child in node)
+    return False
+
+
+def is_multiline(pattern):
+    """
+    True if the compiled pattern is meant to match across lines, i.e. it contains a newline
+    (also in character classes like [\\r\\n]) or lets '.' match newlines with (?s).
+    """
+    return bool(pattern.flags & re.DOTALL) or _contains_newline(sre_parse.parse(pattern.pattern, pattern.flags))
+
+
+def _line_pieces(literals):
+    """
+    A literal of a multi-line pattern may contain newlines itself ('Remote Cache:\\nio.grpc...').
+    Returns the longest single-line piece of every literal, or None if one of them has no usable piece.
+    """
+    if literals is None:
+        return None
+    pieces = set()
+    for literal in literals:
+        piece = max(literal.split("\n"), key=len)
+        if len(piece) < MIN_LITERAL_LENGTH:
+            return None
+        pieces.add(piece)
+    return pieces
+
+
+def _trie_regex(literals):
+    """
+    Builds a regex out of a trie of the literals, so the regex engine walks the trie character by
+    character instead of trying every literal one after another at each position.
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def to_regex(node):
+        alternatives = [re.escape(char) + to_regex(child) for char, child in node.items() if char]
+        if not alternatives:
+            return ""
+        regex = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        # literal may end here -> the rest is optional, greedy so the longest literal is found
+        return f"(?:{regex})?" if "" in node else regex
+
+    return to_regex(trie)
+
+
+class LiteralScanner:
+    """
+    Aho-Corasick-style multi-literal scanner: finds all of the given literals that occur in a string
+    with a single pass of one compiled regex.
+    The trie regex sits inside a lookahead, so it is tried at every position without consuming
+    anything and reports the longest literal starting there. Literals that are contained in a
+    found literal (and might therefore be hidden by it) are added through a precomputed closure.
+    """
+    def __init__(self, literals):
+        self.literals = sorted(set(literals))
+        self.regex = re.compile(f"(?=({_trie_regex(self.literals)}))") if self.literals else None
+        self.contained = {literal: [other for other in self.literals if other in literal] for literal in self.literals}
+
+    def scan(self, text):
+        """
+        Returns the set of literals contained in text.
+        """
+        found = set()
+        if self.regex is None:
+            return found
+        for longest in set(self.regex.findall(text)):
+            found.update(self.contained[longest])
+        return found
+
+
+class PatternMatcher:
+    """
+    Matches log lines against all compiled patterns in one pass per line.
+    compiled_patterns is the dictionary {(main_category, sub_category): [compiled regex, ...]}
+    as built in step_3_build_dataset.compile_patterns.
+    """
+    def __init__(self, compiled_patterns):
+        self.compiled_patterns = compiled_patterns
+        # Flat list in the same order as the nested loop over compiled_patterns.items()
+        self.entries = []
+        self.literals = []
+        for (main_category, sub_category), regex_list in compiled_patterns.items():
+            for pattern in regex_list:
+                self.entries.append((main_category, sub_category, pattern))
+                self.literals.append(required_literals(pattern))
+
+        # literal index: literal -> positions of the patterns that require it
+        literal_index = {}
+        self.always_run = []
+        for position, literals in enumerate(self.literals):
+            if literals is None:
+                self.always_run.append(position)
+                continue
+            for literal in literals:
+                literal_index.setdefault(literal, []).append(position)
+        self.literal_index = literal_index
+
+        # Multi-line patterns: compiled with re.MULTILINE so '^' and '$' still mean start/end of a line
+        # when searching the joined stdout, indexed by the single-line pieces of their literals
+        self.multiline = [is_multiline(pattern) for _, _, pattern in self.entries]
+        self.multiline_regex = {}
+        self.multiline_index = {}
+        self.multiline_always = []
+        for position, (_, _, pattern) in enumerate(self.entries):
+            if not self.multiline[position]:
+                continue
+            self.multiline_regex[position] = re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+            pieces = _line_pieces(self.literals[position])
+            if pieces is None:
+                self.multiline_always.append(position)
+                continue
+            for piece in pieces:
+                self.multiline_index.setdefault(piece, []).append(position)
+
+        self.scanner = LiteralScanner(set(literal_index) | set(self.multiline_index))
+
+    def candidates(self, log_entry):
+        """
+        Returns the sorted positions (in self.entries) of the patterns that can possibly match the line.
+        """
+        positions = set(self.always_run)
+        for literal in self.scanner.scan(log_entry):
+            positions.update(self.literal_index.get(literal, ()))
+        return sorted(positions)
+
+    def match_line(self, log_entry):
+        """
+        Returns a list of (main_category, sub_category, match) for a single log line.
+        """
+        matches_list = []
+        for position in self.candidates(log_entry):
+            main_category, sub_category, pattern = self.entries[position]
+            match = pattern.search(log_entry)
+            if match:
+                matches_list.append((main_category, sub_category, match))
+        return matches_list
+
+    def match_lines(self, log_entries):
+        """
+        Returns a list of (main_category, sub_category, match) for all given log lines.
+        """
+        matches_list = []
+        for log_entry in log_entries:
+            matches_list.extend(self.match_line(log_entry))
+        return matches_list
+
+    def match_log(self, log_entries, text=None):
+        """
+        Matches the stdout of a task in a single pass, including the multi-line patterns.
+        text is "\\n".join(log_entries), pass it in if it was already built.
+        Returns a list of (line_number, main_category, sub_category, match) sorted by the line the
+        match starts on. Matches of multi-line patterns are matches on text, not on a single line.
+        """
+        matches_list = []
+        hit_lines = {}
+        for line_number, log_entry in enumerate(log_entries):
+            positions = set(self.always_run)
+            for literal in self.scanner.scan(log_entry):
+                positions.update(self.literal_index.get(literal, ()))
+                for position in self.multiline_index.get(literal, ()):
+                    hit_lines.setdefault(position, []).append(line_number)
+            for position in sorted(positions):
+                if self.multiline[position]:
+                    continue
+                main_category, sub_category, pattern = self.entries[position]
+                match = pattern.search(log_entry)
+                if match:
+                    matches_list.append((line_number, position, main_category, sub_category, match))
+
+        if hit_lines or self.multiline_always:
+            if text is None:
+                text = "\n".join(log_entries)
+            line_starts = [0] + list(itertools.accumulate(len(log_entry) + 1 for log_entry in log_entries))
+            last_line = len(log_entries) - 1
+            for position in self.multiline_always:
+                hit_lines[position] = range(last_line + 1)
+            for position, lines in hit_lines.items():
+                main_category, sub_category, _ = self.entries[position]
+                for first, last in _windows(lines, last_line):
+                    for match in self.multiline_regex[position].finditer(text, line_starts[first], line_starts[last + 1] - 1):
+                        line_number = bisect.bisect_right(line_starts, match.start()) - 1
+                        matches_list.append((line_number, position, main_category, sub_category, match))
+
+        matches_list.sort(key=lambda m: (m[0], m[1]))
+        return [(line_number, main_category, sub_category, match) for line_number, _, main_category, sub_category, match in matches_list]
+
+
+def _windows(lines, last_line):
+    """
+    Merges the windows of MULTILINE_WINDOW lines around each hit line into (first, last) line ranges.
+    """
+    windows = []
+    for line in lines:
+        first, last = max(0, line - MULTILINE_WINDOW), min(last_line, line + MULTILINE_WINDOW)
+        if windows and first <= windows[-1][1] + 1:
+            windows[-1] = (windows[-1][0], last)
+        else:
+            windows.append((first, last))
+    return windows
@@ -0,0 +1,133 @@
+"""
+Shared record of how far every log got through the pipeline:
+    downloaded   -> raw job output is in 'logs' (step 1)
+    cropped      -> '<log>_cropped.json' is in 'preprocessed_logs' (step 2)
+    datasetized  -> '<log>_cropped.csv' is in 'datasets' or rows of the log are in a Parquet shard
+                    (source_log column of 'datasets/*.parquet') (step 3)
+    blacklisted  -> log can not be used, never touch it again
+
+The states are kept in an append-only file (one "<state>\t<log base name>" per line, the last line
+of a log wins), loaded once into a dict. So "was this log already handled?" is a dict lookup instead
+of several os.path.exists calls and a scan through the blacklist for every single log.
+
+If the state file does not exist yet, it is built from what is on disk (the three folders, the
+Parquet shards and blacklist.txt). Entries added to blacklist.txt by hand are picked up on every load.
+To rebuild the state file from disk:
+    $ python3 processed_state.py --rebuild
+"""
+import argparse
+import os
+
+STATE_FILE = 'processed_state.log'
+BLACKLIST = 'blacklist.txt'
+STATES = ('downloaded', 'cropped', 'datasetized', 'blacklisted')
+# folder -> state of the logs in it
+STAGE_DIRS = (('logs', 'downloaded'), ('preprocessed_logs', 'cropped'), ('datasets', 'datasetized'))
+# folders with Parquet shards of step 3 ('datasets_parquet' of older runs), every log in their source_log column is datasetized
+PARQUET_DIRS = ('datasets', 'datasets_parquet')
+
+
+def log_base_name(path):
+    """
+    'foo/abc__job-output.json', 'abc__job-output_cropped.json' and 'abc__job-output_cropped.csv' -> 'abc__job-output'
+    """
+    base_name = os.path.splitext(os.path.basename(path))[0]
+    if base_name.endswith('_cropped'):
+        base_name = base_name[:-len('_cropped')]
+    return base_name
+
+
+class ProcessedState:
+    def __init__(self, path=STATE_FILE, blacklist=BLACKLIST):
+        self.path = path
+        self.blacklist_path = blacklist
+        self.states = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    state, _, base_name = line.rstrip("\n").partition("\t")
+                    if state in STATES and base_name:
+                        self.states[base_name] = state
+        else:
+            self.rebuild()
+        self._load_blacklist()
+
+    def _load_blacklist(self):
+        if not os.path.exists(self.blacklist_path):
+            return
+        with open(self.blacklist_path, 'r') as file:
+            for line in file.read().splitlines():
+                if line.strip():
+                    self.states[log_base_name(line.strip())] = 'blacklisted'
+
+    def rebuild(self):
+        """
+        Rebuilds the state of every log from the folders on disk and writes a fresh state file.
+        """
+        self.states = {}
+        for directory, state in STAGE_DIRS:
+            if os.path.isdir(directory):
+                for file in os.listdir(directory):
+                    if not file.endswith(('.parquet', '.part')):
+                        self.states[log_base_name(file)] = state
+        for source_log in self._parquet_source_logs():
+            self.states[log_base_name(source_log)] = 'datasetized'
+        self._load_blacklist()
+        with open(self.path, 'w') as file:
+            for base_name, state in self.states.items():
+                file.write(f"{state}\t{base_name}\n")
+
+    @staticmethod
+    def _parquet_source_logs():
+        """
+        Yields the logs with rows in the finished Parquet shards (only the source_log column is read).
+        Unfinished shards ('.part') are skipped, their logs are not deleted yet and are datasetized again.
+        """
+        shards = [os.path.join(directory, file) for directory in PARQUET_DIRS if os.path.isdir(directory)
+                  for file in sorted(os.listdir(directory)) if file.endswith('.parquet')]
+        if not shards:
+            return
+        import pyarrow.parquet as pq     # only needed if there are shards
+        for shard in shards:
+            try:
+                table = pq.read_table(shard, columns=['source_log'])
+            except Exception as e:
+                print(f"Could not read source_log of {shard}: {e}")
+                continue
+            yield from table.column('source_log').unique().to_pylist()
+
+    def get(self, path):
+        """
+        Returns the state of the log (any of its file names or paths works), None if it is unknown.
+        """
+        return self.states.get(log_base_name(path))
+
+    def mark(self, path, state):
+        if state not in STATES:
+            raise ValueError(f"Unknown state {state!r}, expected one of {STATES}")
+        base_name = log_base_name(path)
+        if self.states.get(base_name) == state:
+            return
+        self.states[base_name] = state
+        with open(self.path, 'a') as file:
+            file.write(f"{state}\t{base_name}\n")
+
+    def blacklist(self, path):
+        """
+        Blacklists the log, also in blacklist.txt so it stays blacklisted if the state file is rebuilt.
+        """
+        with open(self.blacklist_path, 'a') as blacklist:
+            blacklist.write("\n")
+            blacklist.write(os.path.basename(path))
+        self.mark(path, 'blacklisted')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shows or rebuilds the processing state of the logs")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the state file from the folders on disk")
+    args = parser.parse_args()
+    processed_state = ProcessedState()
+    if args.rebuild:
+        processed_state.rebuild()
+    for state in STATES:
+        print(f"{state}: {sum(1 for s in processed_state.states.values() if s == state)}")
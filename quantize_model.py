@@ -0,0 +1,85 @@
+"""
+Exports the dynamic int8 quantized model (model/model_int8.pt, see inference_util.quantize_classifier) and compares it
+with the float32 model on the held-out split (test split of train_util or --input_dir), on the CPU:
+    accuracy and macro F1 against the labels, agreement with the float32 predictions,
+    latency of a single example (batch size 1, median and 95th percentile), throughput in batches and size on disk.
+
+    $ python3 quantize_model.py --num_threads 4 --max_examples 2000
+    $ python3 test.py --quantized
+"""
+import argparse
+import itertools
+import os
+import sys
+import warnings
+
+import numpy as np
+import torch
+import train_util
+import inference_util
+
+from os import listdir
+from sklearn.metrics import accuracy_score, f1_score
+from transformers import logging as transformers_logging
+
+# Suppress warnings
+warnings.filterwarnings('ignore', category=FutureWarning)
+warnings.filterwarnings('ignore', category=DeprecationWarning)
+transformers_logging.set_verbosity_error()
+
+
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Exports the int8 quantized model and compares it with the float32 model")
+    parser.add_argument("--model_dir", default=inference_util.MODEL_DIR, help="Directory of the model saved by train.py")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint of train_model to quantize instead of model_dir/model.pt")
+    parser.add_argument("--input_dir", default=None, help="Held-out datasets (default: test split of train_util)")
+    parser.add_argument("--max_examples", type=int, default=1000, help="Number of held-out examples to compare on")
+    parser.add_argument("--n_latency", type=int, default=100, help="Number of examples to measure the single example latency on")
+    parser.add_argument("--batch_size", type=int, default=inference_util.INFERENCE_BATCH_SIZE, help="Examples per forward pass")
+    parser.add_argument("--max_token_length", type=int, default=512, help="Maximum number of tokens per example")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of torch (default: torch default)")
+    parser.add_argument("--no_report", action="store_true", help="Only export the quantized model")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configuration = parse_input_arguments()
+    _, quantized_path = inference_util.export_quantized(configuration.model_dir, configuration.checkpoint)
+    print(f"Saved quantized model to {quantized_path}")
+    if configuration.no_report:
+        sys.exit()
+
+    if configuration.input_dir is not None:
+        dir_path = configuration.input_dir
+        dataset_names = sorted(f for f in listdir(dir_path) if f.endswith((".csv", ".parquet")))
+    else:
+        dir_path, dataset_names = train_util.DIR, train_util.test_dataset_names
+
+    fp32_path = configuration.checkpoint or os.path.join(configuration.model_dir, "model.pt")
+    report = {}
+    for name, quantized, path in (("fp32", False, fp32_path), ("int8", True, quantized_path)):
+        model, tokenizer, label_mapping = inference_util.load_classifier(configuration.model_dir, configuration.checkpoint, quantized)
+        engine = inference_util.InferenceEngine(model, tokenizer, label_mapping, batch_size=configuration.batch_size,
+                                                max_token_length=configuration.max_token_length, num_threads=configuration.num_threads,
+                                                device="cpu")
+        if name == "fp32":
+            examples = list(itertools.islice(engine.read_examples(dataset_names, dir_path), configuration.max_examples))
+            texts = [text for _, _, text in examples]
+            labels = [example.get("main_category", "") for _, example, _ in examples]
+            print(f"Comparing on {len(texts)} examples of {len(dataset_names)} datasets ({torch.get_num_threads()} threads)")
+        predictions, latencies, throughput = inference_util.benchmark_engine(engine, texts, configuration.n_latency)
+        report[name] = (predictions, latencies, throughput, os.path.getsize(path) / 2 ** 20)
+
+    labelled = [index for index, label in enumerate(labels) if label in label_mapping]
+    print(f"{'':6}{'accuracy':>10}{'macro F1':>10}{'agreement':>11}{'p50 ms':>9}{'p95 ms':>9}{'ex/s':>9}{'MB':>9}")
+    for name, (predictions, latencies, throughput, size) in report.items():
+        if labelled:
+            true = [labels[index] for index in labelled]
+            predicted = [predictions[index] for index in labelled]
+            accuracy = accuracy_score(true, predicted)
+            macro_f1 = f1_score(true, predicted, average="macro", zero_division=0)
+        else:
+            accuracy = macro_f1 = float("nan")
+        agreement = np.mean([a == b for a, b in zip(predictions, report["fp32"][0])])
+        print(f"{name:6}{accuracy:>10.4f}{macro_f1:>10.4f}{agreement:>11.4f}{np.percentile(latencies, 50):>9.2f}"
+              f"{np.percentile(latencies, 95):>9.2f}{throughput:>9.1f}{size:>9.1f}")
@@ -12,69 +12,303 @@ NO MORE SECRETS!
 
 To count files in a dir in Unix: 
     ls -1 | wc -l
+
+Downloads run in parallel (--workers) on one shared client. To try it without the real bucket,
+point --endpoint_url at a local MinIO server, or call download_objects with a client inside moto's mock_aws().
 """
 
 import argparse
 import boto3
 import os
 import logging
+import queue
+import random
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from processed_state import ProcessedState
+from step_2_crop_logs import extract_error_info_from_stream, save_cropped, TARGET_DIR
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 BLACKLIST = 'blacklist.txt'
+RAW_LOGS_DIR = 'logs'
+LISTING_POSITION = 'listing_position.txt'    # last key looked at, the next run continues after it
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_QUEUE_SIZE = 16      # chunks buffered between download and parsing (per object)
+# error codes of requests that can never succeed, they are not retried
+PERMANENT_ERRORS = {"NoSuchKey", "NoSuchBucket", "404", "AccessDenied", "403", "InvalidObjectState"}
 
-def main(configuration):
-    # Initialise the client
-    s3 = boto3.client(
+
+def create_client(configuration):
+    """
+    One client is shared by all download threads (boto3 clients are thread safe),
+    its connection pool is sized to the number of workers.
+    endpoint_url can point to a MinIO (or any other S3 compatible) server.
+    botocore does not retry (max_attempts 1): failed downloads are retried with backoff by download_object
+    and stream_crop_object (--retries), which also covers errors while reading the body.
+    """
+    return boto3.client(
         "s3",
         aws_access_key_id=configuration.aws_access_key_id,
         aws_secret_access_key=configuration.aws_secret_access_key,
+        endpoint_url=configuration.endpoint_url,
+        config=Config(max_pool_connections=max(10, configuration.workers), retries={"max_attempts": 1, "mode": "standard"}),
     )
 
+
+def iter_object_keys(s3, bucket_name, prefix="", start_after=""):
+    """
+    Lazily lists the keys of the bucket (1000 per request), starting after start_after.
+    When the end of the bucket is reached, the listing wraps around and continues from the
+    beginning up to start_after, so objects before the saved position are not missed.
+    """
+    def list_pages(start_after):
+        kwargs = {"Bucket": bucket_name, "Prefix": prefix}
+        if start_after:
+            kwargs["StartAfter"] = start_after
+        while True:
+            response = s3.list_objects_v2(**kwargs)
+            for obj in response.get('Contents', []):
+                yield obj['Key']
+            if not response.get('IsTruncated'):
+                return
+            kwargs.pop("StartAfter", None)
+            kwargs["ContinuationToken"] = response['NextContinuationToken']
+
+    yield from list_pages(start_after)
+    if start_after:
+        for key in list_pages(""):
+            # start_after itself was already listed in the first pass
+            if key >= start_after:
+                return
+            yield key
+
+
+def load_listing_position(path=LISTING_POSITION):
+    if not os.path.exists(path):
+        return ""
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+def save_listing_position(key, path=LISTING_POSITION):
+    with open(path, 'w') as f:
+        f.write(key)
+
+
+def is_permanent_error(error):
+    return isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") in PERMANENT_ERRORS
+
+
+def download_object(s3, bucket_name, key, target_dir=RAW_LOGS_DIR, retries=3, backoff=1.0):
+    """
+    Downloads a single object to target_dir. The object is written to a temporary '.part' file first and
+    renamed when complete, so a crashed or failed download never leaves a half written log behind.
+    Failed downloads are retried with exponential backoff (+ jitter), except for PERMANENT_ERRORS.
+    Returns:
+        int: Size of the downloaded log in bytes.
+    """
+    target_path = os.path.join(target_dir, os.path.basename(key))
+    temp_path = f"{target_path}.part"
+    for attempt in range(retries + 1):
+        try:
+            s3.download_file(bucket_name, key, temp_path)
+            os.replace(temp_path, target_path)
+            return os.path.getsize(target_path)
+        except Exception as e:
+            # ClientError/BotoCoreError, S3TransferFailedError of the transfer manager, OSError of the local write
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if attempt == retries or is_permanent_error(e):
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logging.warning(f"Download of {key} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def download_objects(s3, bucket_name, keys, workers=8, target_dir=RAW_LOGS_DIR, retries=3, on_downloaded=None):
+    """
+    Downloads the objects with a pool of worker threads and reports progress and throughput.
+    on_downloaded(key) is called in the calling thread for every finished download.
+    Returns:
+        tuple: (number of downloaded objects, number of failed objects, downloaded bytes)
+    """
+    start = time.perf_counter()
+    downloaded, failed, total_bytes = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_object, s3, bucket_name, key, target_dir, retries): key for key in keys}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                total_bytes += future.result()
+            except Exception as e:
+                failed += 1
+                logging.error(f"Could not download {key}: {e}")
+                continue
+            downloaded += 1
+            if on_downloaded is not None:
+                on_downloaded(key)
+            seconds = time.perf_counter() - start
+            logging.info(f"[{downloaded + failed}/{len(futures)}] {key} "
+                         f"({total_bytes / 1024**2:.1f} MB, {total_bytes / 1024**2 / seconds:.1f} MB/s, {downloaded / seconds:.1f} logs/s)")
+    return downloaded, failed, total_bytes
+
+
+############################################################# Fused download + crop #####################################################
+class ChunkQueue:
+    """
+    File-like object between a download thread and the parser: the download thread puts the chunks of
+    an S3 body into a bounded queue, read() hands them to the parser. Downloading and parsing overlap,
+    but the download can never run more than STREAM_QUEUE_SIZE chunks ahead.
+    """
+    def __init__(self, maxsize=STREAM_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize)
+        self.stopped = threading.Event()
+        self.finished = False
+
+    def fill(self, body, chunk_size=STREAM_CHUNK_SIZE):
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                if not self._put(chunk):
+                    return
+            self._put(b"")
+        except Exception as e:
+            self._put(e)
+        finally:
+            body.close()
+
+    def _put(self, item):
+        # don't block forever if the parser gave up
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self, size=-1):
+        if self.finished:
+            return b""
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        self.finished = not item
+        return item
+
+    def close(self):
+        self.stopped.set()
+
+
+def stream_crop_object(s3, bucket_name, key, target_dir=TARGET_DIR, retries=3, backoff=1.0):
+    """
+    Streams an object from S3 directly into the failed-host extraction of step 2 and
+    only writes '<log>_cropped.json', the raw log never touches the disk.
+    Returns:
+        int: Number of extracted error infos (0 = no failed host, nothing written).
+    """
+    for attempt in range(retries + 1):
+        chunks = ChunkQueue()
+        try:
+            body = s3.get_object(Bucket=bucket_name, Key=key)['Body']
+            download = threading.Thread(target=chunks.fill, args=(body,), daemon=True)
+            download.start()
+            try:
+                error_info = extract_error_info_from_stream(chunks)
+            finally:
+                chunks.close()
+                download.join()
+        except (BotoCoreError, ClientError) as e:
+            if attempt == retries or is_permanent_error(e):
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logging.warning(f"Streaming {key} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        if error_info:
+            save_cropped(error_info, os.path.basename(key), target_dir)
+        return len(error_info)
+
+
+def stream_crop_objects(s3, bucket_name, keys, workers=8, target_dir=TARGET_DIR, retries=3, processed_state=None):
+    """
+    Streams and crops the objects with a pool of worker threads, see stream_crop_object.
+    Returns:
+        tuple: (number of cropped objects, number of objects without failed hosts, number of failed objects)
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    start = time.perf_counter()
+    cropped, no_errors, failed = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(stream_crop_object, s3, bucket_name, key, target_dir, retries): key for key in keys}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                n_errors = future.result()
+            except Exception as e:
+                failed += 1
+                logging.error(f"Could not stream and crop {key}: {e}")
+                continue
+            if n_errors:
+                cropped += 1
+                if processed_state is not None:
+                    processed_state.mark(key, 'cropped')
+            else:
+                # nothing in it to learn from, don't pick it again (blacklist.txt too, so a rebuild keeps it),
+                # step_2_crop_logs does the same with downloaded logs
+                no_errors += 1
+                if processed_state is not None:
+                    processed_state.blacklist(key)
+            seconds = time.perf_counter() - start
+            logging.info(f"[{cropped + no_errors + failed}/{len(futures)}] {key}: {n_errors} failed hosts "
+                         f"({(cropped + no_errors) / seconds:.1f} logs/s)")
+    return cropped, no_errors, failed
+
+
+def main(configuration):
+    # Initialise the client
+    s3 = create_client(configuration)
+
     # Ensure the directory "logs" exists
-    if not os.path.exists("logs"):
-        os.makedirs("logs")
-
-    # Generating a list of all objects in increments of 1000 (list_objects_v2 returns 1000 max.)
-    actually_all_objects = []
-    start_after_key = ""
-    while True: 
-        response = s3.list_objects_v2(Bucket=configuration.bucket_name, StartAfter= start_after_key)
-        all_objects = [obj['Key'] for obj in response.get('Contents', [])]
-        if not all_objects:
-            logging.error("No more objects found in the bucket.")
-            break
-        start_after_key = all_objects[-1]
-        actually_all_objects.extend(all_objects)
-
-
-    # Choosing defined number of objects from actually_all_objects
+    if not os.path.exists(RAW_LOGS_DIR):
+        os.makedirs(RAW_LOGS_DIR)
+
+    # Going lazily through the objects of the bucket (resuming where the last run stopped)
+    # and choosing the defined number of objects, the listing stops as soon as enough are found
+    processed_state = ProcessedState(blacklist=BLACKLIST)
+    start_after_key = "" if configuration.restart_listing else load_listing_position()
     chosen_objects = set()
-    object_iterator = iter(actually_all_objects)
-    while len(chosen_objects) < configuration.num_files:
-        current_object = next(object_iterator, "end")
-        # If not enough new objects in bucket:
-        if current_object == "end":
-            logging.warning(f"only {len(chosen_objects)} objects found")
-            break
-
-        # Building filenames for the check ([0] = extract without extension)
-        with open(BLACKLIST, 'r') as f:
-            blacklist = f.read().splitlines()
-
-        base_filename = os.path.splitext(os.path.basename(current_object))[0]
-        preprocessed_filepath = os.path.join("preprocessed_logs", f"{base_filename}_cropped.json")
-        datasets_filepath = os.path.join("datasets", f"{base_filename}_cropped.csv")
-        # Does log exist in datasets or preprocessed already? (Yes: skip, No: add to chosen_objects)
-        if not os.path.exists(preprocessed_filepath) and not os.path.exists(datasets_filepath) and not current_object in blacklist:
+    last_key = start_after_key
+    for current_object in iter_object_keys(s3, configuration.bucket_name, configuration.prefix, start_after_key):
+        last_key = current_object
+        # Was the log downloaded, preprocessed, datasetized or blacklisted already? (Yes: skip, No: add to chosen_objects)
+        if processed_state.get(current_object) is None:
             chosen_objects.add(current_object)
+            if len(chosen_objects) >= configuration.num_files:
+                break
+    # If not enough new objects in bucket:
+    if len(chosen_objects) < configuration.num_files:
+        logging.warning(f"only {len(chosen_objects)} objects found")
+    save_listing_position(last_key)
+
+    # Stream chosen_objects directly into the cropping of step 2
+    if configuration.stream_crop:
+        cropped, no_errors, failed = stream_crop_objects(
+            s3, configuration.bucket_name, sorted(chosen_objects), configuration.workers,
+            retries=configuration.retries, processed_state=processed_state
+        )
+        print(f"Finished cropping {cropped} new logs, {no_errors} without failed hosts, {failed} failed")
+        return
 
     # Download chosen_objects
-    for obj in chosen_objects:
-        raw_logs_dir = os.path.join("logs", os.path.basename(obj))
-        logging.info(f"Downloading {obj} to {raw_logs_dir}")
-        s3.download_file(configuration.bucket_name, obj, raw_logs_dir)
-    print(f"Finished downloading {len(chosen_objects)} new logs")
+    downloaded, failed, total_bytes = download_objects(
+        s3, configuration.bucket_name, sorted(chosen_objects), configuration.workers,
+        retries=configuration.retries, on_downloaded=lambda obj: processed_state.mark(obj, 'downloaded')
+    )
+    print(f"Finished downloading {downloaded} new logs ({total_bytes / 1024**2:.1f} MB), {failed} failed")
 
 
 def parse_input_arguments():
@@ -89,6 +323,25 @@ def parse_input_arguments():
     parser.add_argument(
         "--num_files", type=int, default=20, help="Number of files to download"
     )
+    parser.add_argument(
+        "--prefix", default="", help="Only list objects whose key starts with this prefix"
+    )
+    parser.add_argument(
+        "--restart_listing", action="store_true", help=f"Start listing from the beginning instead of the key in '{LISTING_POSITION}'"
+    )
+    parser.add_argument(
+        "--endpoint_url", default=None, help="S3 endpoint, e.g. of a local MinIO server (default: AWS)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="Number of parallel downloads"
+    )
+    parser.add_argument(
+        "--stream_crop", action="store_true",
+        help="Crop the objects while downloading them (step 2) and only write the '_cropped.json' files"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=3, help="How often a failed download is retried"
+    )
     args = parser.parse_args()
     return args
 
@@ -1,6 +1,11 @@
 # Preprocess logs
+import argparse
 import json
 import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from processed_state import ProcessedState
  
 
 # Usage:
@@ -8,41 +13,27 @@ SOURCE_DIR = 'logs'
 TARGET_DIR = 'preprocessed_logs'
 DATASET_DIR='datasets'
 BLACKLIST='blacklist.txt'
+CHUNK_SIZE = 1024 * 1024     # bytes read at once from a log
 
-def decide_file_handling(blacklist):
+def decide_file_handling(processed_state):
     """
     1: Welche files müssen preproc werden?
         - nicht in datasets
         - nicht bereits aussortiert (aus gründen nicht benutzen) -> blacklist.txt
         - nicht in preprocessed_logs
+    (-> state of the log in processed_state)
     """
-    # Load the blacklist.txt
-    with open(blacklist, 'r') as f:
-        blacklist = f.read().splitlines()
     files_to_process = []
     
     # check all files
     for file in os.listdir(SOURCE_DIR):
-        # Build paths
-        base_filename = os.path.splitext(file)[0]
         source_filepath = os.path.join(SOURCE_DIR, file)
-        preprocessed_filepath = os.path.join(TARGET_DIR, f"{base_filename}_cropped.json")
-        datasets_filepath = os.path.join(DATASET_DIR, f"{base_filename}_cropped.csv")        
         
         if os.path.isfile(source_filepath):
             # does log already exist in any of the other folders?
-            # if (os.path.exists(datasets_filepath) or file in blacklist or os.path.exists(preprocessed_filepath)):
-            #     os.remove(source_filepath)
-            #     print(f"Deleted log file {source_filepath} as the log was either processed or blacklisted previously")
-            
-            if os.path.exists(datasets_filepath):
-                print(f"{source_filepath} was found in 'datasets'.")
-                os.remove(source_filepath)
-            elif os.path.exists(preprocessed_filepath):
-                print(f"{source_filepath} was found in 'preprocessed_logs'.")
-                os.remove(source_filepath)
-            elif file in blacklist:
-                print(f"{source_filepath} was found in 'blacklist'.")
+            state = processed_state.get(file)
+            if state in ('cropped', 'datasetized', 'blacklisted'):
+                print(f"{source_filepath} was found in '{state}'.")
                 os.remove(source_filepath)
             # => the file needs to be processed
             else:
@@ -54,64 +45,341 @@ def decide_file_handling(blacklist):
     return files_to_process
 
 
-def extract_error_info_from_file(filenameWithExtension):
+############################################################# Streaming JSON reader #####################################################
+_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+_STRING_BODY = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+# everything up to the next bracket, complete strings included (a string cut off by the chunk end stops it at its quote)
+_NO_STRUCTURE = re.compile(rb'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+_SCALAR = re.compile(rb'[^,\]}\s]*')
+
+
+class JsonStreamReader:
+    """
+    Minimal incremental JSON reader on a binary stream (open file, S3 body, ...).
+    Only the current chunk and the value that is being read are held in memory, values that are
+    not needed are skipped without building python objects out of them.
+
+    iter_array/iter_object yield once per element (object: the key), the caller has to consume
+    exactly one value (read_value, read_raw, skip_value, iter_...) before asking for the next one.
     """
-    Extracts error information from the specified JSON log file.        
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self.keep = None     # start of the value that is currently captured, kept when reading more
+
+    def _more(self):
+        """
+        Reads the next chunk, drops what was already consumed. Returns False at the end of the stream.
+        """
+        cut = self.pos if self.keep is None else self.keep
+        if cut:
+            del self.buffer[:cut]
+            self.pos -= cut
+            if self.keep is not None:
+                self.keep -= cut
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer += chunk
+        return True
+
+    def peek(self):
+        """
+        Returns the next non-whitespace byte (without consuming it), b'' at the end of the stream.
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self._more():
+                return bytes(self.buffer[self.pos:self.pos + 1])
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} but found {self.peek()!r}")
+        self.pos += 1
+
+    def expect_end(self):
+        if self.peek() != b"":
+            raise ValueError(f"Extra data after the JSON document: {self.peek()!r}")
+
+    def _skip_string(self):
+        self.pos += 1
+        while True:
+            self.pos = _STRING_BODY.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) and self.buffer[self.pos] == ord('"'):
+                self.pos += 1
+                return
+            if not self._more():
+                raise ValueError("Unterminated string")
+
+    def skip_value(self):
+        char = self.peek()
+        if char == b'"':
+            self._skip_string()
+        elif char in (b'[', b'{'):
+            depth = 0
+            while True:
+                self.pos = _NO_STRUCTURE.match(self.buffer, self.pos).end()
+                if self.pos >= len(self.buffer):
+                    if not self._more():
+                        raise ValueError("Unexpected end of JSON")
+                    continue
+                char = self.buffer[self.pos]
+                if char == ord('"'):
+                    self._skip_string()
+                    continue
+                self.pos += 1
+                depth += 1 if char in b'[{' else -1
+                if depth == 0:
+                    return
+        elif char:
+            while True:
+                self.pos = _SCALAR.match(self.buffer, self.pos).end()
+                if self.pos < len(self.buffer) or not self._more():
+                    return
+        else:
+            raise ValueError("Unexpected end of JSON")
+
+    def read_raw(self):
+        """
+        Returns the raw bytes of the next value.
+        """
+        self.peek()
+        self.keep = self.pos
+        try:
+            self.skip_value()
+            return bytes(self.buffer[self.keep:self.pos])
+        finally:
+            self.keep = None
+
+    def read_value(self):
+        return json.loads(self.read_raw())
+
+    def iter_array(self):
+        self.expect(b'[')
+        if self.peek() == b']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == b']':
+                self.pos += 1
+                return
+            self.expect(b',')
+
+    def iter_object(self):
+        self.expect(b'{')
+        if self.peek() == b'}':
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != b'"':
+                raise ValueError(f"Expected a key but found {self.peek()!r}")
+            key = self.read_value()
+            self.expect(b':')
+            yield key
+            if self.peek() == b'}':
+                self.pos += 1
+                return
+            self.expect(b',')
+
+
+def read_failed_host(reader):
+    """
+    Reads a host result. Returns its stdout_lines if the host failed, None otherwise.
+    stdout_lines is only kept as raw bytes until it is clear whether the host failed.
+    """
+    failed = None
+    raw_stdout_lines = None
+    for key in reader.iter_object():
+        if key == 'failed':
+            failed = reader.read_value()
+        elif key == 'stdout_lines' and (failed is None or failed):
+            raw_stdout_lines = reader.read_raw()
+        else:
+            reader.skip_value()
+    if not failed:
+        return None
+    return json.loads(raw_stdout_lines) if raw_stdout_lines is not None else []
+
+
+def read_failed_task(reader):
+    """
+    Reads a task (task info + host results) and returns the error info of its failed hosts.
+    """
+    task_info = {}
+    failed_hosts = []
+    for key in reader.iter_object():
+        if key == 'task':
+            task_info = reader.read_value()
+        elif key == 'hosts':
+            failed_hosts = []
+            for node in reader.iter_object():
+                stdout_lines = read_failed_host(reader)
+                if stdout_lines is not None:
+                    failed_hosts.append(stdout_lines)
+        else:
+            reader.skip_value()
+
+    task_id = task_info.get('id', 'No ID provided')
+    error_info_list = []
+    for stdout_lines in failed_hosts:
+        error_info = {
+            'stdout_lines': stdout_lines,
+            'id': task_id
+        }
+        # Logging for diagnostic purposes
+        if task_id == 'No ID provided':
+            print(f"Missing ID in task: {task_info}")
+        error_info_list.append(error_info)
+    return error_info_list
+
+
+def extract_error_info_from_stream(stream):
+    """
+    Walks items -> plays -> tasks -> hosts of a job output while reading it and
+    only materializes stdout_lines and id of failed hosts.
     Returns:
         list: A list of dictionaries containing error information.
     """
-    log_filepath = os.path.join("logs", filenameWithExtension)    
+    reader = JsonStreamReader(stream)
     error_info_list = []
+    # data = list of dicts (items)
+    # items = dict mit : branch, index, phase, playbook (all strings), plays (list), stats(dict)
+    # plays = list of dicts ( u.a. tasks, tasks = list of dicts)
+    # tasks = list of dicts of hosts
+    for item in reader.iter_array():
+        for key in reader.iter_object():
+            if key != 'plays':
+                reader.skip_value()
+                continue
+            for play in reader.iter_array():
+                for key in reader.iter_object():
+                    if key != 'tasks':
+                        reader.skip_value()
+                        continue
+                    for task in reader.iter_array():
+                        error_info_list.extend(read_failed_task(reader))
+    reader.expect_end()
+    return error_info_list
+
+
+def extract_error_info_from_file(filenameWithExtension):
+    """
+    Extracts error information from the specified JSON log file.
+    The file is streamed, so memory stays bounded no matter how large the log is.
+    Returns:
+        list: A list of dictionaries containing error information, None if the file is broken.
+    """
+    log_filepath = os.path.join("logs", filenameWithExtension)    
+    error_info_list = None
     try:
-        with open(log_filepath, 'r', encoding='utf-8') as file:
-            data = json.load(file)
-
-        # data = list of dicts (items)
-        # items = dict mit : branch, index, phase, playbook (all strings), plays (list), stats(dict)
-        # plays = list of dicts ( u.a. tasks, tasks = list of dicts)
-        # tasks = list of dicts of hosts
-        # # hosts =  
-        for item in data:
-            for play in item.get('plays', []):
-                for task in play.get('tasks', []):
-                    task_info = task.get('task', {})
-                    task_id = task_info.get('id', 'No ID provided')
-                    for node, host_info in task.get('hosts', {}).items():
-                        if host_info.get('failed'):
-                            error_info = {
-                                'stdout_lines': host_info.get('stdout_lines', []),
-                                'id': task_id
-                            }
-                            # Logging for diagnostic purposes
-                            if task_id == 'No ID provided':
-                                print(f"Missing ID in task: {task_info}")
-                            error_info_list.append(error_info)
+        with open(log_filepath, 'rb') as file:
+            error_info_list = extract_error_info_from_stream(file)
     except Exception as e:
         print(f"An error occurred while processing {log_filepath}: {e}")
     return error_info_list
 
-def save_error_info(target_dir):
+def save_cropped(error_info, filename, target_dir):
+    """
+    Saves the error information of a log as '<log>_cropped.json' in the output directory.
+    """
+    new_filename = f"{os.path.splitext(filename)[0]}_cropped.json"
+    new_file_path = os.path.join(target_dir, new_filename)
+    with open(new_file_path, 'w', encoding='utf-8') as new_file:
+        json.dump(error_info, new_file, indent=4)
+    return new_file_path
+
+
+def crop_file(filename, target_dir):
+    """
+    Extracts the error information of a single log, saves it as '<log>_cropped.json' in the
+    output directory and deletes the log. Logs without failed hosts are blacklisted by save_error_info
+    (like in the fused download + crop of step 1), broken logs are kept.
+    Returns:
+        tuple: (filename, number of extracted error infos (None: broken log), seconds it took)
+    """
+    start = time.perf_counter()
+    error_info = extract_error_info_from_file(filename)
+    if error_info is None:
+        return filename, None, time.perf_counter() - start
+    if error_info:
+        save_cropped(error_info, filename, target_dir)
+        old_path = os.path.join('logs', filename)
+        os.remove(old_path)
+    return filename, len(error_info), time.perf_counter() - start
+
+
+def save_error_info(target_dir, workers=1, max_inflight_mb=1024):
     """
     Processes all log files in the specified directory, extracts error information,
-    and saves the information to new files in the output directory.    
+    and saves the information to new files in the output directory.
+    With workers > 1 the logs are cropped in a pool of worker processes. New logs are only handed
+    to the pool while the logs in flight are smaller than max_inflight_mb in total (at least one
+    log is always in flight), so a bunch of huge logs can not be cropped at the same time.
     Returns:
-        list: A list of dictionaries containing all extracted error information.
-    """     
-    all_error_info = []
+        dict: Counts and timings of the run (the error information is only written to disk).
+    """
+    start = time.perf_counter()
     os.makedirs(target_dir, exist_ok=True)
-    files_to_process = decide_file_handling(BLACKLIST)
-    for filename in files_to_process:
-        error_info = extract_error_info_from_file(filename)
-        all_error_info.extend(error_info)
-        if error_info:
-            new_filename = f"{os.path.splitext(filename)[0]}_cropped.json"
-            new_file_path = os.path.join(target_dir, new_filename)
-            with open(new_file_path, 'w', encoding='utf-8') as new_file:
-                json.dump(error_info, new_file, indent=4)
-            old_path = os.path.join('logs', filename)
-            # print(old_path)
-            os.remove(old_path)
-    return all_error_info
-
-
-error_info_list = save_error_info(TARGET_DIR)
+    processed_state = ProcessedState(blacklist=BLACKLIST)
+    files_to_process = decide_file_handling(processed_state)
+    stats = {'files': len(files_to_process), 'cropped': 0, 'no_errors': 0, 'broken': 0, 'errors': 0, 'crop_seconds': 0.0}
+
+    def add_result(result):
+        filename, n_errors, seconds = result
+        stats['crop_seconds'] += seconds
+        if n_errors is None:
+            stats['broken'] += 1
+            return
+        if n_errors:
+            processed_state.mark(filename, 'cropped')
+            stats['cropped'] += 1
+            stats['errors'] += n_errors
+        else:
+            # nothing in it to learn from, don't pick it again (same as step_1_download_new_objects.stream_crop_objects)
+            processed_state.blacklist(filename)
+            os.remove(os.path.join(SOURCE_DIR, filename))
+            stats['no_errors'] += 1
+
+    if workers <= 1:
+        for filename in files_to_process:
+            add_result(crop_file(filename, target_dir))
+    else:
+        max_inflight_bytes = max_inflight_mb * 1024 * 1024
+        pending = list(reversed(files_to_process))
+        in_flight = {}      # future -> size of the log in bytes
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while pending or in_flight:
+                while pending and len(in_flight) < 2 * workers:
+                    size = os.path.getsize(os.path.join(SOURCE_DIR, pending[-1]))
+                    if in_flight and sum(in_flight.values()) + size > max_inflight_bytes:
+                        break
+                    in_flight[executor.submit(crop_file, pending.pop(), target_dir)] = size
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del in_flight[future]
+                    add_result(future.result())
+
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Crops the logs in 'logs' down to the output of failed hosts")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes (1 = no parallelism)"
+    )
+    parser.add_argument(
+        "--max_inflight_mb", type=int, default=1024, help="Max. total size of the logs that are cropped at the same time"
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    configuration = parse_input_arguments()
+    stats = save_error_info(TARGET_DIR, configuration.workers, configuration.max_inflight_mb)
+    print(f"Cropped {stats['cropped']} of {stats['files']} logs ({stats['errors']} failed hosts), "
+          f"{stats['no_errors']} without failed hosts blacklisted, {stats['broken']} broken, in {stats['seconds']:.1f}s ({stats['crop_seconds']:.1f}s of cropping)")
@@ -1,13 +1,26 @@
+import argparse
 import json
 import re
 import os
+import time
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from multiprocessing import Pool
 from collections import defaultdict
+from pattern_util import PatternMatcher
+from processed_state import ProcessedState
+from text_store import TextStore, TEXT_STORE
+from generate_label_mapping import LabelMapping, LABEL_MAPPING
 
 
 INPUT_DIR = 'preprocessed_logs'
 OUTPUT_DIRECTORY = 'datasets'
+PARQUET_DIRECTORY = OUTPUT_DIRECTORY     # next to the CSVs, train_util reads both from there
+ROWS_PER_SHARD = 200000
+ROWS_PER_ROW_GROUP = 10000
 BLACKLIST = 'blacklist.txt'
+PATTERNS = 'patterns.json'
 
 def load_pattern(file_path):
     with open(file_path, 'r') as file:
@@ -16,13 +29,14 @@ def load_pattern(file_path):
 
 def compile_patterns(patterns):
     """	
-    Compiles the restructured patterns dictionary into a dictionary of compiled regex patterns.	
+    Compiles the restructured patterns dictionary into a dictionary of compiled regex patterns	
+    and builds the PatternMatcher (required-literal index) on top of it.	
     """	
     compiled_patterns = {}	
     for main_category, subpatterns in patterns.items():	
         for sub_category, patterns in subpatterns.items():	
             compiled_patterns.setdefault((main_category, sub_category), []).extend([re.compile(pattern) for pattern in patterns])	
-    return compiled_patterns
+    return PatternMatcher(compiled_patterns)
 
 
 def load_blacklist_file():
@@ -30,46 +44,37 @@ def load_blacklist_file():
         return file 
 
 
-def purge_log_lines(log_entries, cutoff_intervall = 1000):
+def in_purged_log(line_number, n_lines, cutoff_intervall = 1000):
     """
-    Purges log lines to keep only the start and end intervals if the log is too long.
+    True if the line is kept when the log is purged to the start and end intervals (log is too long).
     """
-    if len(log_entries) < 2*cutoff_intervall:
-        return log_entries
-    start_intervall = log_entries[:cutoff_intervall]
-    end_intervall = log_entries[-cutoff_intervall:]
-    return start_intervall + end_intervall
+    if n_lines < 2*cutoff_intervall:
+        return True
+    return line_number < cutoff_intervall or line_number >= n_lines - cutoff_intervall
 
 
-def check_purged_log(log_entries, compiled_patterns):
-    purged_log_entries = purge_log_lines(log_entries, 1000)
-    matches_list = []
-    for log_entry in purged_log_entries:
-        for (main_category, sub_category), regex_list in compiled_patterns.items():
-            for pattern in regex_list:
-                match = pattern.search(log_entry)
-                if match:
-                    matches_list.append((main_category, sub_category, match))
-    return matches_list
-
-
-def check_full_log(log_entries, compiled_patterns):
-    matches_list = []
-    for log_entry in log_entries:
-        for (main_category, sub_category), regex_list in compiled_patterns.items():
-            for pattern in regex_list:
-                match = pattern.search(log_entry)
-                if match:
-                    matches_list.append((main_category, sub_category, match))
-    return matches_list
+def check_log(log_entries, stdout_text, matcher):
+    """
+    Matches the whole log once (incl. multi-line patterns) and returns (main_category, sub_category, match, match_lines),
+    match_lines are the numbers of the lines the match covers, e.g. "17 18".
+    Matches in the start and end intervals of the log (purged log) are preferred,
+    matches in the middle of a long log are only used if there are none in the purged log.
+    """
+    line_matches = matcher.match_log(log_entries, stdout_text)
+    purged_matches = [m for m in line_matches if in_purged_log(m[0], len(log_entries), 1000)]
+    if purged_matches:
+        line_matches = purged_matches
+    return [(main_category, sub_category, match, " ".join(str(line) for line in range(line_number, line_number + match.group().count("\n") + 1)))
+            for line_number, main_category, sub_category, match in line_matches]
 
 
-def process_single_file(directory_path, filename, compiled_patterns):
+def process_single_file(directory_path, filename, matcher):
     """
-    Processes a single log file and returns a dateset with task_id, log entries, main_category, sub_category.
+    Processes a single log file and returns a dateset with task_id, log entries, main_category, sub_category, match_lines.
     """
     dataset = []
     task_matches = {}
+    match_lines = {}
     file_path = os.path.join(directory_path, filename)
 
     try:
@@ -82,90 +87,307 @@ def process_single_file(directory_path, filename, compiled_patterns):
 
                 stdout_text = "\n".join(log.get('stdout_lines', []))
 
-                # check shortened log version, returns 'none' if no match found in short version
-                matches_list = check_purged_log(log.get('stdout_lines', []), compiled_patterns)
+                # check the log, purged log first, full version if no match found in the purged log
+                matches_list = check_log(log.get('stdout_lines', []), stdout_text, matcher)
                 if matches_list:
                     task_matches.setdefault(task_key, defaultdict(set))
                     for match in matches_list:
-                        main_category, sub_category, pattern = match
+                        main_category, sub_category, pattern, lines = match
                         task_matches[task_key][(main_category, sub_category, pattern)].add(stdout_text)
+                        match_lines[(task_key, main_category, sub_category, pattern)] = lines
                     for (main_category, sub_category, pattern), log_entries in task_matches[task_key].items():
-                        dataset.append((task_id, "\n".join(log_entries), main_category, sub_category))
-                else: 
-                    # check full version
-                    matches_list = check_full_log(task_key, defaultdict(set))
-
-                    if matches_list:
-                        task_matches.setdefault(task_key, defaultdict(set))
-                        for match in matches_list:
-                            main_category, sub_category, pattern = match
-                            task_matches[task_key][(main_category, sub_category, pattern)].add(stdout_text)
-                        for (main_category, sub_category, pattern), log_entries in task_matches[task_key].items():
-                            dataset.append((task_id, "\n".join(log_entries), main_category, sub_category))
-                    # still no matches? Theres a unknown error, label as such and proceed
-                    else:
-                        isthisadict ={}
-                        isthisadict.setdefault(task_id, defaultdict(set))
-                        for log_entry in log_entries:
-                            dataset.append((task_id, stdout_text, "Unknown error", "Unknown error"))
+                        dataset.append((task_id, "\n".join(log_entries), main_category, sub_category, match_lines[(task_key, main_category, sub_category, pattern)]))
+                # no matches? Theres a unknown error, label as such and proceed
+                else:
+                    isthisadict ={}
+                    isthisadict.setdefault(task_id, defaultdict(set))
+                    for log_entry in log_entries:
+                        dataset.append((task_id, stdout_text, "Unknown error", "Unknown error", ""))
 
     except json.JSONDecodeError:
-        with open(BLACKLIST, 'a') as blacklist:
-            blacklist.write("\n")
-            blacklist.write(filename)
-        os.remove(file_path)
-        print(f"Error decoding JSON file {filename}, File has been deleted and added to the blacklist.")
-        return None, None, None
+        # Blacklisting and deleting is done by the caller (only one process may write the blacklist)
+        raise
     
     if dataset:
         output_file_name = os.path.splitext(filename)[0] + ".csv"
         output_path = os.path.join("datasets", output_file_name)
-        dataset_df = pd.DataFrame(dataset, columns=['task_id', 'log_line', 'main_category', 'sub_category'])
+        dataset_df = pd.DataFrame(dataset, columns=['task_id', 'log_line', 'main_category', 'sub_category', 'match_lines'])
         return output_path, output_file_name, dataset_df
     
     else:
         return None, None, None
     
 
-def process_all_files(directory_path, compiled_patterns):
+def blacklist_log(directory_path, filename, processed_state):
+    """
+    Adds a log that can not be decoded to the blacklist and deletes it.
+    """
+    processed_state.blacklist(filename)
+    os.remove(os.path.join(directory_path, filename))
+    print(f"Error decoding JSON file {filename}, File has been deleted and added to the blacklist.")
+
+
+def select_files(directory_path, processed_state):
+    """
+    Returns the logs in the given directory that still need to be processed.
+    Deletes logs whose CSV dataset already exists or that were blacklisted previously.
+    """
+    files_to_process = []
+    for file in [f for f in os.listdir(directory_path) if f.endswith('.json')]:
+        if processed_state.get(file) in ('datasetized', 'blacklisted'):
+            os.remove(os.path.join(directory_path, file))
+            print(f"Deleted {file}, corresponding CSV dataset already exists or log was blacklisted previously.")
+            continue
+        files_to_process.append(file)
+    return files_to_process
+
+
+############################################################# Parquet output #####################################################
+class ParquetShardWriter:
+    """
+    Appends the rows of many logs to Parquet shards ('part-<run>-<n>.parquet') instead of writing one CSV per log.
+    main_category and sub_category are dictionary encoded, source_log is the log a row comes from,
+    match_lines are the numbers of the lines of the log text that matched the pattern.
+    A shard is written to a '.part' file and renamed when it is complete. The callback of a log
+    (marking it as datasetized, deleting it) only runs once the shard with its rows is on disk,
+    so a crash never loses rows of logs that were already deleted.
+    text_column is 'log_line', or 'text_id' if the texts are deduplicated into the TextStore.
+    """
+    def __init__(self, output_dir=PARQUET_DIRECTORY, rows_per_shard=ROWS_PER_SHARD, rows_per_row_group=ROWS_PER_ROW_GROUP, text_column='log_line'):
+        self.SCHEMA = pa.schema([
+            ('task_id', pa.string()),
+            (text_column, pa.string()),
+            ('main_category', pa.dictionary(pa.int32(), pa.string())),
+            ('sub_category', pa.dictionary(pa.int32(), pa.string())),
+            ('match_lines', pa.string()),
+            ('source_log', pa.string()),
+        ])
+        self.text_column = text_column
+        self.output_dir = output_dir
+        self.rows_per_shard = rows_per_shard
+        self.rows_per_row_group = rows_per_row_group
+        self.run = time.strftime("%Y%m%d-%H%M%S")
+        self.shard_number = 0
+        self.writer = None
+        self.shard_rows = 0
+        self.buffer = []        # tables not yet written as row group
+        self.buffered_rows = 0
+        self.callbacks = []     # on_written of the logs in the current shard
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _shard_path(self):
+        return os.path.join(self.output_dir, f"part-{self.run}-{self.shard_number:05d}.parquet")
+
+    def write(self, source_log, dataset_df, on_written=None):
+        table = pa.Table.from_arrays([
+            pa.array(dataset_df['task_id'].astype(str).tolist(), pa.string()),
+            pa.array(dataset_df[self.text_column].tolist(), pa.string()),
+            pa.array(dataset_df['main_category'].tolist(), pa.string()).dictionary_encode(),
+            pa.array(dataset_df['sub_category'].tolist(), pa.string()).dictionary_encode(),
+            pa.array(dataset_df['match_lines'].tolist(), pa.string()),
+            pa.array([source_log] * len(dataset_df), pa.string()),
+        ], schema=self.SCHEMA)
+        self.buffer.append(table)
+        self.buffered_rows += len(dataset_df)
+        if on_written is not None:
+            self.callbacks.append(on_written)
+        if self.buffered_rows >= self.rows_per_row_group:
+            self._flush()
+        if self.shard_rows >= self.rows_per_shard:
+            self._close_shard()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self._shard_path() + ".part", self.SCHEMA)
+        self.writer.write_table(pa.concat_tables(self.buffer), row_group_size=self.rows_per_row_group)
+        self.shard_rows += self.buffered_rows
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def _close_shard(self):
+        self._flush()
+        if self.writer is None:
+            return
+        self.writer.close()
+        os.replace(self._shard_path() + ".part", self._shard_path())
+        print(f"Saved shard {self._shard_path()} ({self.shard_rows} rows)")
+        self.writer = None
+        self.shard_rows = 0
+        self.shard_number += 1
+        for callback in self.callbacks:
+            callback()
+        self.callbacks = []
+
+    def close(self):
+        self._close_shard()
+
+
+def finish_log(directory_path, filename, output_file_name, processed_state):
+    """
+    Called once the rows of a log are saved: marks the log as datasetized and deletes it.
+    """
+    processed_state.mark(filename, 'datasetized')
+    os.remove(os.path.join(directory_path, filename))
+    print(f"Processed and saved: {output_file_name}")
+
+
+def save_rows(directory_path, filename, output_path, output_file_name, dataset_df, processed_state, parquet_writer=None, text_store=None, label_mapping=None):
     """
-    Processes all log files in the given directory, saving each one as a separate .csv in "datasets".
+    Saves the rows of a log as CSV (or appends them to the shards of parquet_writer).
+    With a text_store the log texts are stored there once and the rows only reference them by 'text_id'.
+    New main categories are appended to the label_mapping.
+    """
+    if label_mapping is not None:
+        for label in label_mapping.update(dataset_df['main_category'].unique()):
+            print(f"New label '{label}' -> {label_mapping.mapping[label]}")
+    if text_store is not None:
+        dataset_df = text_store.deduplicate(dataset_df)
+    if parquet_writer is not None:
+        parquet_writer.write(filename, dataset_df, lambda file=filename, name=f"rows of {filename}": finish_log(directory_path, file, name, processed_state))
+    else:
+        dataset_df.to_csv(output_path, index=False)
+        finish_log(directory_path, filename, output_file_name, processed_state)
+
+
+def process_all_files(directory_path, matcher, parquet_writer=None, text_store=None, label_mapping=None):
+    """
+    Processes all log files in the given directory, saving each one as a separate .csv in "datasets"
+    (or appending its rows to the shards of parquet_writer).
     Skips processing if the corresponding file already exists.
     """
-    files = [f for f in os.listdir(directory_path) if f.endswith('.json')]
-
-    for file in files:
-        output_file_name = os.path.splitext(file)[0] + ".csv"
-        output_path = os.path.join(OUTPUT_DIRECTORY, output_file_name)
-        file_path = os.path.join(directory_path, file)
-        with open(BLACKLIST, 'r') as blacklist:
-            if os.path.exists(output_path) or file in blacklist: 
-                os.remove(file_path)
-                print(f"Deleted {file}, corresponding CSV dataset already exists or log was blacklisted previously.")
-                continue
-                
-            # Process file
-            output_path, output_file_name, dataset_df = process_single_file(directory_path, file, compiled_patterns)
-            if dataset_df is not None:
-                dataset_df.to_csv(output_path, index=False)
-                os.remove(file_path)
-                print(f"Processed and saved: {output_file_name}")
+    processed_state = ProcessedState(blacklist=BLACKLIST)
+    for file in select_files(directory_path, processed_state):
+        # Process file
+        try:
+            output_path, output_file_name, dataset_df = process_single_file(directory_path, file, matcher)
+        except json.JSONDecodeError:
+            blacklist_log(directory_path, file, processed_state)
+            continue
+        if dataset_df is None:
+            print('dataset_df is None')
+        else:
+            save_rows(directory_path, file, output_path, output_file_name, dataset_df, processed_state, parquet_writer, text_store, label_mapping)
+    if parquet_writer is not None:
+        parquet_writer.close()
+    return 
+
+
+############################################################# Parallel mode #####################################################
+# Every worker process compiles the patterns once and keeps them in _worker_matcher.
+# Workers only read their log and write their own CSV, everything that touches shared state
+# (blacklist.txt, deleting logs, the Parquet shards, the text store) is done by the coordinating main process.
+_worker_matcher = None
+
+
+def init_worker(patterns_file):
+    global _worker_matcher
+    _worker_matcher = compile_patterns(load_pattern(patterns_file))
+
+
+def process_file_in_worker(task):
+    """
+    Processes a single log in a worker process, CSVs are saved right away, for Parquet (or the text store)
+    the rows are sent back to the main process.
+    Returns (filename, status, output_file_name, dataset_df, labels) with status 'saved', 'rows', 'empty' or 'invalid',
+    labels are the main categories of the saved rows (for the label mapping).
+    """
+    directory_path, filename, return_rows = task
+    try:
+        output_path, output_file_name, dataset_df = process_single_file(directory_path, filename, _worker_matcher)
+    except json.JSONDecodeError:
+        return filename, 'invalid', None, None, None
+    if dataset_df is None:
+        return filename, 'empty', None, None, None
+    if return_rows:
+        return filename, 'rows', output_file_name, dataset_df, None
+    dataset_df.to_csv(output_path, index=False)
+    return filename, 'saved', output_file_name, None, list(dataset_df['main_category'].unique())
+
+
+def process_all_files_parallel(directory_path, patterns_file, workers, chunksize=None, parquet_writer=None, text_store=None, label_mapping=None):
+    """
+    Same as process_all_files, but the logs are fanned out over a pool of worker processes.
+    Results are handled in the order they complete.
+    """
+    processed_state = ProcessedState(blacklist=BLACKLIST)
+    files = select_files(directory_path, processed_state)
+    if not files:
+        return
+    if chunksize is None:
+        # a few chunks per worker, so slow (huge) logs do not leave the other workers idle at the end
+        chunksize = max(1, len(files) // (workers * 4))
+    return_rows = parquet_writer is not None or text_store is not None
+    tasks = [(directory_path, file, return_rows) for file in files]
+    with Pool(workers, initializer=init_worker, initargs=(patterns_file,)) as pool:
+        for filename, status, output_file_name, dataset_df, labels in pool.imap_unordered(process_file_in_worker, tasks, chunksize=chunksize):
+            if status == 'saved':
+                if label_mapping is not None:
+                    for label in label_mapping.update(labels):
+                        print(f"New label '{label}' -> {label_mapping.mapping[label]}")
+                finish_log(directory_path, filename, output_file_name, processed_state)
+            elif status == 'rows':
+                output_path = os.path.join(OUTPUT_DIRECTORY, output_file_name)
+                save_rows(directory_path, filename, output_path, output_file_name, dataset_df, processed_state, parquet_writer, text_store, label_mapping)
+            elif status == 'invalid':
+                blacklist_log(directory_path, filename, processed_state)
             else:
                 print('dataset_df is None')
-    return 
+    if parquet_writer is not None:
+        parquet_writer.close()
 
 
-def main():
+def main(configuration):
     """
     Main function to restructure, compile patterns and process log files.
     """
-    # Compile the restructured patterns
-    all_patterns = load_pattern("patterns.json")
-    compiled_patterns = compile_patterns(all_patterns)
+    os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
+    text_store = TextStore(configuration.text_store) if configuration.dedupe_text else None
+    label_mapping = LabelMapping(configuration.label_mapping)
+    text_column = 'text_id' if text_store is not None else 'log_line'
+    parquet_writer = ParquetShardWriter(configuration.parquet_dir, text_column=text_column) if configuration.output_format == 'parquet' else None
+    if configuration.workers > 1:
+        process_all_files_parallel(INPUT_DIR, configuration.patterns, configuration.workers, configuration.chunksize, parquet_writer, text_store, label_mapping)
+    else:
+        # Compile the restructured patterns
+        all_patterns = load_pattern(configuration.patterns)
+        matcher = compile_patterns(all_patterns)
+
+        # Process log files
+        process_all_files(INPUT_DIR, matcher, parquet_writer, text_store, label_mapping)
+
+    if text_store is not None:
+        n_texts, n_rows = text_store.stats()
+        print(f"Text store: {n_rows} rows reference {n_texts} unique texts")
+        text_store.close()
+
+
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Builds the datasets out of the preprocessed logs")
+    parser.add_argument("--patterns", default=PATTERNS, help="Patterns file")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes (1 = no parallelism)"
+    )
+    parser.add_argument(
+        "--chunksize", type=int, default=None, help="Logs handed to a worker at once (default: a few chunks per worker)"
+    )
+    parser.add_argument(
+        "--output_format", choices=["csv", "parquet"], default="csv",
+        help=f"One CSV per log in '{OUTPUT_DIRECTORY}' or Parquet shards with the rows of many logs"
+    )
+    parser.add_argument("--parquet_dir", default=PARQUET_DIRECTORY, help="Directory of the Parquet shards")
+    parser.add_argument(
+        "--dedupe_text", action="store_true",
+        help="Store every log text once in the text store, rows only reference it by 'text_id'"
+    )
+    parser.add_argument("--text_store", default=TEXT_STORE, help="SQLite file of the text store")
+    parser.add_argument("--label_mapping", default=LABEL_MAPPING, help="Label mapping, new main categories are appended")
+    args = parser.parse_args()
+    return args
 
-    # Process log files
-    process_all_files(INPUT_DIR, compiled_patterns)
 
 # Run the main function
 if __name__ == '__main__':
-    main()
+    configuration = parse_input_arguments()
+    main(configuration)
@@ -1,71 +1,80 @@
-import numpy as np
-import random
-import os
-import torch
+import argparse
 import warnings
+import torch
+import pandas as pd
 import train_util
-
-import torch.nn as nn
-import json
-import torch.optim as optim
+import inference_util
 
 from os import listdir
-from datasets import load_dataset
-from transformers import RobertaTokenizer
-from torch.utils.data import Dataset
-from transformers import AutoModel
+from text_store import TextStore
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
-from torch.optim.lr_scheduler import CosineAnnealingLR
 from transformers import logging as transformers_logging
 
 # Suppress warnings
 warnings.filterwarnings('ignore', category=FutureWarning)
 transformers_logging.set_verbosity_error()
-warnings.filterwarnings(
-    'ignore',
-    message="The dataloader, val_dataloader 0, does not have many workers which may be a bottleneck."
-)
-LIST_OF_DATASETS = listdir("/home/q524745/bachelor_thesis/ten_ds")
-DIR = "ten_ds"  ## TODO change
-TRAIN_PERCENTAGE = 0.8
-TEST_PERCENTAGE = 0.2
-
-random.shuffle(LIST_OF_DATASETS)
 
-SPLIT_CUTOFF = int(len(LIST_OF_DATASETS) * TRAIN_PERCENTAGE)
+PREDICTIONS_FILE = "predictions.csv"
 
-train_dataset_names  = LIST_OF_DATASETS[:SPLIT_CUTOFF]
-test_dataset_names = LIST_OF_DATASETS[SPLIT_CUTOFF:]
 
-tokenizer = RobertaTokenizer.from_pretrained("roberta-base")
+def predict_on_testdata(engine, dataset_names, dir_path, output_path=PREDICTIONS_FILE, text_store=None):
+    """
+    Predicts all examples of the datasets in batches and writes the predictions to output_path.
+    """
+    n_examples, seconds = engine.predict_datasets(dataset_names, dir_path, output_path, text_store=text_store)
+    print(f"Predicted {n_examples} examples in {seconds:.1f}s: {n_examples / max(seconds, 1e-9):.1f} examples/s "
+          f"({engine.device}, {torch.get_num_threads()} threads, batch size {engine.batch_size})")
+    print(f"Saved predictions to {output_path}")
+    return n_examples
 
-config = {
-    "learning_rate": 1e-5, 
-    "weight_decay": 0.01,
-    "n_epochs": 1,
-    "batch_size": 16            # depends on memory
-}
 
-def predict_on_testdata(model, data_module):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
-    model.eval()
+def evaluate(output_path, label_mapping):
+    """
+    Compares the predictions with the main_category of the rows (rows with a label the model does not know are skipped).
+    """
+    predictions = pd.read_csv(output_path, keep_default_na=False, dtype=str)
+    predictions = predictions[predictions["label"].isin(label_mapping)]
+    if predictions.empty:
+        print("No labelled examples to evaluate")
+        return
+    labels, predicted = predictions["label"], predictions["prediction"]
+    print(f"Accuracy: {accuracy_score(labels, predicted):.4f}")
+    print(f"Precision (macro): {precision_score(labels, predicted, average='macro', zero_division=0):.4f}")
+    print(f"Recall (macro): {recall_score(labels, predicted, average='macro', zero_division=0):.4f}")
+    print(f"F1 (macro): {f1_score(labels, predicted, average='macro', zero_division=0):.4f}")
 
-    predictions = []
-    test_stream = data_module.test_dataloader()
 
-    with torch.no_grad():
-        for example in test_stream:
-            batch = {k: v.to(device) for k, v, in example.items()}            
-            loss, logits = model(batch["input_ids"], batch["attention_mask"])       
-            predictions.append(torch.argmax(logits, dim=1).cpu().numpy())               # TODO HUH?
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Predicts the main category of the test datasets with a trained model")
+    parser.add_argument("--model_dir", default=inference_util.MODEL_DIR, help="Directory of the model saved by train.py")
+    parser.add_argument("--quantized", action="store_true", help="Use the int8 model of quantize_model.py (CPU)")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint of train_model to load instead of model_dir/model.pt")
+    parser.add_argument("--input_dir", default=None, help="Predict all datasets in this directory (default: test split of train_util)")
+    parser.add_argument("--output", default=PREDICTIONS_FILE, help="CSV file for the predictions")
+    parser.add_argument("--batch_size", type=int, default=inference_util.INFERENCE_BATCH_SIZE, help="Examples per forward pass")
+    parser.add_argument("--max_token_length", type=int, default=512, help="Maximum number of tokens per example")
+    parser.add_argument("--top_k", type=int, default=3, help="Number of labels (with probability) per example")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of torch on the CPU (default: torch default)")
+    parser.add_argument("--text_store", default=None, help="Text store of step 3 (datasets built with --dedupe_text)")
+    parser.add_argument("--error_window", action="store_true", help="Cut long logs to the lines around the matched lines")
+    parser.add_argument("--no_evaluation", action="store_true", help="Only write the predictions")
+    return parser.parse_args()
 
-    return np.concatenate(predictions)
 
-# Run
-data_module = train_util.CustomDataModule(train_dataset_names,test_dataset_names, DIR, batch_size=config["batch_size"])
-data_module.setup()
-model= 0    # TODO load saved model  
-predictions = predict_on_testdata(model, data_module)
+if __name__ == "__main__":
+    configuration = parse_input_arguments()
+    if configuration.input_dir is not None:
+        dir_path = configuration.input_dir
+        dataset_names = sorted(f for f in listdir(dir_path) if f.endswith((".csv", ".parquet")))
+    else:
+        dir_path, dataset_names = train_util.DIR, train_util.test_dataset_names
 
-# TODO Evaluation? Welche Metrik?
\ No newline at end of file
+    model, tokenizer, label_mapping = inference_util.load_classifier(configuration.model_dir, configuration.checkpoint, configuration.quantized)
+    engine = inference_util.InferenceEngine(model, tokenizer, label_mapping, batch_size=configuration.batch_size,
+                                            max_token_length=configuration.max_token_length, top_k=configuration.top_k,
+                                            num_threads=configuration.num_threads, error_window=configuration.error_window,
+                                            device="cpu" if configuration.quantized else None)
+    text_store = TextStore(configuration.text_store) if configuration.text_store else None
+    predict_on_testdata(engine, dataset_names, dir_path, configuration.output, text_store=text_store)
+    if not configuration.no_evaluation:
+        evaluate(configuration.output, label_mapping)
@@ -0,0 +1,62 @@
+"""
+Tests of the downloader of step 1 against an S3 bucket mocked by moto (offline).
+"""
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import step_1_download_new_objects as step_1
+
+BUCKET = "zuul-logs"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setattr(step_1.time, "sleep", lambda seconds: None)    # no backoff in the tests
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def test_listing_pages_and_wraps_around(s3):
+    # more keys than one page of list_objects_v2 (1000)
+    keys = sorted(f"job-{index:05d}__job-output.json" for index in range(1005))
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"[]")
+
+    assert list(step_1.iter_object_keys(s3, BUCKET)) == keys
+    # continues after the saved position and wraps around to the keys before it, every key exactly once
+    start_after = keys[500]
+    assert list(step_1.iter_object_keys(s3, BUCKET, start_after=start_after)) == keys[501:] + keys[:500]
+
+
+def test_download_retries_and_skips_failed_keys(s3, tmp_path):
+    s3.put_object(Bucket=BUCKET, Key="a__job-output.json", Body=b"[]")
+    s3.put_object(Bucket=BUCKET, Key="b__job-output.json", Body=b"[1]")
+
+    download_file = s3.download_file
+    calls = []
+
+    def flaky_download_file(bucket_name, key, path):
+        calls.append(key)
+        if key == "a__job-output.json" and calls.count(key) == 1:
+            raise ClientError({"Error": {"Code": "InternalError", "Message": "try again"}}, "GetObject")
+        return download_file(bucket_name, key, path)
+
+    s3.download_file = flaky_download_file
+    downloaded_keys = []
+    downloaded, failed, total_bytes = step_1.download_objects(
+        s3, BUCKET, ["a__job-output.json", "b__job-output.json", "missing__job-output.json"], workers=2,
+        target_dir=str(tmp_path), retries=3, on_downloaded=downloaded_keys.append
+    )
+
+    assert (downloaded, failed, total_bytes) == (2, 1, 5)
+    assert sorted(downloaded_keys) == ["a__job-output.json", "b__job-output.json"]
+    # the transient error is retried, the missing key (404) is not
+    assert calls.count("a__job-output.json") == 2
+    assert calls.count("missing__job-output.json") == 1
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a__job-output.json", "b__job-output.json"]
@@ -0,0 +1,111 @@
+"""
+Tests of the triage service over a Unix socket, fully offline: the patterns of patterns.json and a small random
+classifier (triage_service.random_classifier) with the tokenizer of custom_tokenizer/.
+"""
+import json
+import os
+import threading
+
+import pytest
+
+import inference_util
+from cascade import CascadeClassifier
+from step_3_build_dataset import compile_patterns, load_pattern, PATTERNS
+from triage_service import MicroBatcher, UnixHTTPConnection, create_server, random_classifier
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOB_OUTPUT = [{"plays": [{"tasks": [
+    {"task": {"id": "license"}, "hosts": {"h": {"failed": True, "stdout_lines": ["a", "FlexNet Licensing error:-15,570", "b"]}}},
+    {"task": {"id": "unknown"}, "hosts": {"h": {"failed": True, "stdout_lines": ["nothing to see here"]}}},
+]}]}]
+
+
+@pytest.fixture(scope="module")
+def socket_path(tmp_path_factory):
+    # label_mapping.json, patterns.json and custom_tokenizer/ are read relative to the repository
+    cwd = os.getcwd()
+    os.chdir(REPO_DIR)
+    try:
+        model, tokenizer, label_mapping = random_classifier()
+        engine = inference_util.InferenceEngine(model, tokenizer, label_mapping, max_token_length=64, device="cpu")
+        cascade = CascadeClassifier(compile_patterns(load_pattern(PATTERNS)), engine)
+    finally:
+        os.chdir(cwd)
+    path = str(tmp_path_factory.mktemp("triage") / "triage.sock")
+    server = create_server(cascade, socket_path=path, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    server.batcher.close()
+
+
+def request(socket_path, method, path, body=None, content_type="application/json"):
+    connection = UnixHTTPConnection(socket_path)
+    connection.request(method, path, body=body, headers={"Content-Type": content_type})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_job_output_goes_through_the_cascade(socket_path):
+    status, data = request(socket_path, "POST", "/classify", json.dumps(JOB_OUTPUT))
+    assert status == 200
+    results = {result["id"]: result for result in data["results"]}
+    assert results["license"]["tier"] == "regex"
+    assert results["license"]["confidence"] == 1.0
+    assert results["unknown"]["tier"] == "model"
+    assert 0 < results["unknown"]["confidence"] <= 1
+
+
+def test_concurrent_requests_and_stats(socket_path):
+    statuses = []
+
+    def post(index):
+        statuses.append(request(socket_path, "POST", "/classify", f"plain stdout {index}\nno pattern here", "text/plain")[0])
+
+    threads = [threading.Thread(target=post, args=(index,)) for index in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * 20
+    status, stats = request(socket_path, "GET", "/stats")
+    assert status == 200
+    assert stats["tiers"]["model"]["logs"] >= 20
+    assert stats["mean_batch_size"] >= 1
+
+
+def test_malformed_requests(socket_path):
+    assert request(socket_path, "POST", "/classify", "{bad")[0] == 400
+    assert request(socket_path, "POST", "/classify", json.dumps({"id": "bad", "stdout_lines": None}))[0] == 400
+    assert request(socket_path, "POST", "/classify", json.dumps([{"id": "bad", "stdout_lines": [1, 2]}]))[0] == 400
+    assert request(socket_path, "GET", "/health") == (200, "ok")
+
+
+def test_failing_request_does_not_fail_its_batch():
+    def classify(logs):
+        if any(log.get("boom") for log in logs):
+            raise RuntimeError("boom")
+        return [log["id"] for log in logs]
+
+    batcher = MicroBatcher(classify, max_latency_ms=200)
+    results = {}
+
+    def submit(log):
+        try:
+            results[log["id"]] = batcher.submit([log])
+        except RuntimeError as e:
+            results[log["id"]] = str(e)
+
+    threads = [threading.Thread(target=submit, args=({"id": f"t{index}", "stdout_lines": [], "boom": index == 3},))
+               for index in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+    assert results == {f"t{index}": "boom" if index == 3 else [f"t{index}"] for index in range(6)}
+    # the batches that were classified request by request count as well
+    assert batcher.n_batches >= 1
+    assert batcher.n_logs == 6
@@ -0,0 +1,100 @@
+"""
+Content addressed store for the log texts of the dataset.
+
+The same failure output shows up in thousands of jobs (and a task that matches several patterns
+ends up in several rows), so instead of copying the full text into every row, step 3 can store
+every text once and only write its id into the dataset ('text_id' instead of 'log_line').
+
+    text_id = hash of the normalized text (line endings, trailing whitespace and timestamps unified)
+
+The store is a SQLite file with one table:
+    texts   (text_id, text, count)                 -> first stored copy of the text, number of rows using it
+Training sees (and tokenizes) a text once per split instead of again and again, weighted with the number of rows
+of the split that use it (train_util.CustomDataset.sample_counts).
+"""
+import hashlib
+import os
+import re
+import sqlite3
+
+# next to label_mapping.json, not in datasets/ (everything in there is read as a dataset)
+TEXT_STORE = 'text_store.sqlite'
+
+_TIMESTAMP = re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?')
+
+
+def normalize_text(text):
+    """
+    Normalizes a log text before hashing, so copies that only differ in irrelevant details share one id.
+    """
+    text = text.replace("\r\n", "\n")
+    text = _TIMESTAMP.sub("<timestamp>", text)
+    return "\n".join(line.rstrip() for line in text.split("\n")).strip("\n")
+
+
+def text_hash(text):
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class TextStore:
+    """
+    The SQLite connection is opened lazily in every process that uses the store: a connection must not be carried
+    across fork, and DataLoader workers are forked (not pickled) on Linux.
+    """
+    def __init__(self, path=TEXT_STORE):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS texts (text_id TEXT PRIMARY KEY, text TEXT NOT NULL, count INTEGER NOT NULL)"
+        )
+
+    @property
+    def connection(self):
+        if self._pid != os.getpid():
+            # new process (or first use) -> own connection, the one of the parent is left alone
+            self._connection = sqlite3.connect(self.path)
+            self._pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        # SQLite connections can not be pickled (spawned DataLoader workers), the connection is reopened on first use
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._connection = None
+        self._pid = None
+
+    def add(self, text):
+        """
+        Stores the text (if it is not stored yet), counts the occurrence and returns its text_id.
+        """
+        text_id = text_hash(text)
+        self.connection.execute(
+            "INSERT INTO texts VALUES (?, ?, 1) ON CONFLICT(text_id) DO UPDATE SET count = count + 1", (text_id, text)
+        )
+        return text_id
+
+    def deduplicate(self, dataset_df):
+        """
+        Replaces the 'log_line' column of a dataset of step 3 with the 'text_id' of the stored text.
+        """
+        dataset_df = dataset_df.copy()
+        dataset_df['log_line'] = [self.add(text) for text in dataset_df['log_line']]
+        self.connection.commit()
+        return dataset_df.rename(columns={'log_line': 'text_id'})
+
+    def get(self, text_id):
+        row = self.connection.execute("SELECT text FROM texts WHERE text_id = ?", (text_id,)).fetchone()
+        return row[0] if row else None
+
+    def stats(self):
+        """
+        Returns (number of stored texts, number of rows referencing them).
+        """
+        return self.connection.execute("SELECT COUNT(*), COALESCE(SUM(count), 0) FROM texts").fetchone()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,177 @@
+"""
+Pre-tokenized training data, so the (slow) tokenizer only runs once instead of on every example in every epoch.
+
+A cache holds all examples of a split in flat binary files that are memory-mapped when training:
+    tokens.bin     input ids of all examples, one after the other (uint16, int32 if there are ids > 65535)
+    offsets.bin    int64, example i is tokens[offsets[i]:offsets[i+1]]
+    labels.bin     int64 label id of every example
+    weights.bin    float32 weight of every example (number of rows a deduplicated text stands for, else 1)
+    meta.json      key, dtypes, number of examples and tokens
+
+The cache lives in '<cache_dir>/<split>-<key>', where the key is a hash of the tokenizer, max_length, label mapping,
+further options (error window) and a fingerprint of the datasets (names, sizes and modification times). If any of them changes, the key changes,
+a new cache is built and the old cache of the split is removed.
+
+Build the caches before training (otherwise the first epoch builds them):
+    $ python3 token_cache.py
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+TOKEN_CACHE_DIR = 'token_cache'
+TOKENIZE_BATCH_SIZE = 256
+CACHE_VERSION = 2                # 2: weights of deduplicated texts counted per split
+
+
+def _hash(*parts):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def dataset_fingerprint(dataset_names, dir_path):
+    """
+    Name, size and modification time of every dataset, in the given order (the order of the examples in the cache).
+    """
+    fingerprint = []
+    for file_name in dataset_names:
+        stat = os.stat(os.path.join(dir_path, file_name))
+        fingerprint.append((file_name, stat.st_size, stat.st_mtime_ns))
+    return _hash(fingerprint)
+
+
+def tokenizer_fingerprint(tokenizer):
+    return _hash(type(tokenizer).__name__, tokenizer.name_or_path, sorted(tokenizer.get_vocab().items()),
+                 tokenizer.all_special_tokens)
+
+
+def cache_key(tokenizer, max_length, label_mapping, dataset_names, dir_path, options=None):
+    """
+    options are further settings that change the tokenized examples (e.g. the error window).
+    """
+    return _hash(CACHE_VERSION, tokenizer_fingerprint(tokenizer), max_length, label_mapping,
+                 dataset_fingerprint(dataset_names, dir_path), options)
+
+
+class TokenCache:
+    """
+    Read-only view on a built cache. The arrays are memory-mapped (copy-on-write, so torch.from_numpy does
+    not complain), example i is returned as a view into the token buffer without copying anything.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as file:
+            self.meta = json.load(file)
+        self.tokens = self._map("tokens.bin", self.meta["token_dtype"])
+        self.offsets = self._map("offsets.bin", "int64")
+        self.labels = self._map("labels.bin", "int64")
+        self.weights = self._map("weights.bin", "float32")
+        self.lengths = np.diff(self.offsets)
+
+    def __getstate__(self):
+        # pickling a memmap copies the whole array, DataLoader workers map the files themselves
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _map(self, file_name, dtype):
+        path = os.path.join(self.path, file_name)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="c")
+
+    def __len__(self):
+        return self.meta["n_examples"]
+
+    def __getitem__(self, index):
+        """
+        Returns (input_ids, label, weight) of an example.
+        """
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]], self.labels[index], self.weights[index]
+
+
+def build_token_cache(path, examples, tokenizer, max_length, key=None):
+    """
+    Tokenizes the examples [(text, label_id, weight), ...] batch by batch and writes the cache to path.
+    Everything is written to '<path>.part' first and renamed at the end, so an interrupted build is never used.
+    """
+    token_dtype = np.uint16 if max(tokenizer.get_vocab().values()) <= np.iinfo(np.uint16).max else np.int32
+    part_path = path + ".part"
+    shutil.rmtree(part_path, ignore_errors=True)
+    os.makedirs(part_path)
+    files = {name: open(os.path.join(part_path, name), "wb") for name in ("tokens.bin", "offsets.bin", "labels.bin", "weights.bin")}
+    n_examples, n_tokens = 0, 0
+    files["offsets.bin"].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def write_batch(batch):
+        nonlocal n_examples, n_tokens
+        texts, labels, weights = zip(*batch)
+        encoded = tokenizer(list(texts), add_special_tokens=True, truncation=True, max_length=max_length)["input_ids"]
+        lengths = np.fromiter((len(input_ids) for input_ids in encoded), dtype=np.int64, count=len(encoded))
+        files["tokens.bin"].write(np.fromiter((token for input_ids in encoded for token in input_ids), dtype=token_dtype).tobytes())
+        files["offsets.bin"].write((n_tokens + np.cumsum(lengths)).tobytes())
+        files["labels.bin"].write(np.asarray(labels, dtype=np.int64).tobytes())
+        files["weights.bin"].write(np.asarray(weights, dtype=np.float32).tobytes())
+        n_examples += len(batch)
+        n_tokens += int(lengths.sum())
+
+    try:
+        batch = []
+        for example in examples:
+            batch.append(example)
+            if len(batch) == TOKENIZE_BATCH_SIZE:
+                write_batch(batch)
+                batch = []
+        if batch:
+            write_batch(batch)
+    finally:
+        for file in files.values():
+            file.close()
+
+    with open(os.path.join(part_path, "meta.json"), "w") as file:
+        json.dump({"key": key, "token_dtype": np.dtype(token_dtype).name, "max_length": max_length,
+                   "n_examples": n_examples, "n_tokens": n_tokens}, file)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(part_path, path)
+    print(f"Built token cache {path}: {n_examples} examples, {n_tokens} tokens")
+    return TokenCache(path)
+
+
+def load_or_build_token_cache(cache_dir, split, examples, tokenizer, max_length, label_mapping, dataset_names, dir_path, options=None):
+    """
+    Returns the cache of the split, builds it out of examples() if there is none for the current key.
+    examples is a function, so the datasets are only read (and tokenized) if the cache has to be built.
+    Caches of the split with another key are outdated and removed.
+    """
+    key = cache_key(tokenizer, max_length, label_mapping, dataset_names, dir_path, options)
+    path = os.path.join(cache_dir, f"{split}-{key}")
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return TokenCache(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    for old in os.listdir(cache_dir):
+        if old.startswith(f"{split}-") and old != f"{split}-{key}":
+            shutil.rmtree(os.path.join(cache_dir, old), ignore_errors=True)
+            print(f"Removed outdated token cache {old}")
+    return build_token_cache(path, examples(), tokenizer, max_length, key)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-tokenizes the train and test datasets into the token cache")
+    parser.add_argument("--cache_dir", default=TOKEN_CACHE_DIR, help="Directory of the token caches")
+    parser.add_argument("--max_token_length", type=int, default=512, help="Maximum number of tokens per example")
+    parser.add_argument("--text_store", default=None, help="Text store of step 3 (datasets built with --dedupe_text)")
+    parser.add_argument("--error_window", action="store_true", help="Cut long logs to the lines around the matched lines")
+    args = parser.parse_args()
+
+    import train_util
+    data_module = train_util.CustomDataModule(train_util.train_dataset_names, train_util.test_dataset_names, train_util.DIR,
+                                              max_token_length=args.max_token_length, text_store_path=args.text_store,
+                                              token_cache_dir=args.cache_dir, error_window=args.error_window)
+    data_module.setup()
@@ -3,10 +3,9 @@ import random
 import os
 import warnings
 import train_util
+import inference_util
 import json
 
-from os import listdir
-from transformers import RobertaTokenizer
 from transformers import logging as transformers_logging
 
 # Suppress warnings
@@ -21,7 +20,7 @@ warnings.filterwarnings(
 # DIR = "datasets"
 # TRAIN_PERCENTAGE = 0.8
 # TEST_PERCENTAGE = 0.2
-# OUTPUT_DIR = "model"
+OUTPUT_DIR = "model"
 # random.shuffle(LIST_OF_DATASETS)
 # SPLIT_CUTOFF = int(len(LIST_OF_DATASETS) * TRAIN_PERCENTAGE)
 
@@ -34,39 +33,41 @@ config = {
     "learning_rate": 1e-5, 
     "weight_decay": 0.01,
     "n_epochs": 1,
-    "batch_size": 16            # depends on memory
+    "batch_size": 16,            # depends on memory
+    "checkpoint_dir": "checkpoints",    # killed runs resume from the latest checkpoint here
+    "checkpoint_every": 1000,
+    "keep_checkpoints": 3,
+    "accumulation_steps": 1,            # batches per optimizer step (effective batch size = batch_size * accumulation_steps)
+    "precision": "fp32",                # "bf16" on CPUs with AVX-512 BF16/AMX, "fp16" on GPUs
+    "num_workers": 2,                   # DataLoader processes that read and tokenize the datasets (0: in the training process)
+    "prefetch_factor": 2,               # batches every worker keeps ready
+    "pin_memory": False,                # True when training on a GPU
+    "length_bucketing": True,           # batches of examples with similar length (less padding)
+    "text_store": None                  # text store of step 3 (text_store.sqlite) if the datasets were built with --dedupe_text
 }
 
-with open ('label_mapping.json') as f:
-    label_mapping=json.load(f)
+if __name__ == "__main__":
+    # Init data module and model
+    data_module = train_util.CustomDataModule(train_util.train_dataset_names, train_util.test_dataset_names, train_util.DIR, batch_size=config["batch_size"],
+                                              text_store_path=config["text_store"], length_bucketing=config["length_bucketing"],
+                                              num_workers=config["num_workers"], prefetch_factor=config["prefetch_factor"],
+                                              pin_memory=config["pin_memory"])
+    data_module.setup()
 
-print(label_mapping)
+    with open ('label_mapping.json') as f:
+        label_mapping=json.load(f)
+    n_labels=len(label_mapping)
 
-# if __name__ == "__main__":
-#     # # Init data module and model
-#     # data_module = train_util.CustomDataModule(train_dataset_names,test_dataset_names, DIR, batch_size=config["batch_size"])
-#     # data_module.setup()
+    print(n_labels)
+    model = train_util.RoBERTaClassifier(n_labels=n_labels, vocab_size=train_util.tokenizer_vocab_size(data_module.tokenizer))
 
-#     with open ('label_mapping.json') as f:
-#         label_mapping=json.load(f)
-#     n_labels=len(label_mapping)
-
-#     print(n_labels)
-#     model = train_util.RoBERTaClassifier(n_labels=n_labels)
-
-#     # Train model
-#     trained_model = train_util.train_model(model, config)
-    
-#     # Create output directory if needed
-#     if not os.path.exists(OUTPUT_DIR):
-#         os.makedirs(OUTPUT_DIR)
+    # Train model
+    trained_model = train_util.train_model(model, data_module, config)
     
-#     model_to_save = trained_model.module if hasattr(model, 'module') else trained_model  # Take care of distributed/parallel training
-#     model_to_save.save_pretrained(OUTPUT_DIR)
-#     tokenizer.save_pretrained(OUTPUT_DIR)
-#     print("Saved model to %s" % OUTPUT_DIR)
+    inference_util.save_classifier(trained_model, data_module.tokenizer, OUTPUT_DIR)
+    print("Saved model to %s" % OUTPUT_DIR)
     
     # # TODO Predict on test set
     # predictions = predict_on_testdata(trained_model, data_module)
     # # print(f"Predictions on test set: {predictions}")
-    # print("Training and Predictions completed")
\ No newline at end of file
+    # print("Training and Predictions completed")
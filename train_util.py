@@ -1,22 +1,32 @@
 import numpy as np
 import random
+import itertools
 import os
 import torch
 import warnings
 
 import torch.nn as nn
+import torch.nn.functional as F
 import json
+import hashlib
 import torch.optim as optim
+import pyarrow.parquet as pq
 
 from os import listdir
-from datasets import load_dataset
-from transformers import RobertaTokenizer
-from torch.utils.data import Dataset
-from transformers import AutoModel
+import pandas as pd
+from transformers import RobertaTokenizer, RobertaTokenizerFast
+from tokenizers import Tokenizer, decoders, pre_tokenizers, processors
+from tokenizers.models import BPE
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from transformers import AutoConfig, AutoModel, PretrainedConfig
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from transformers import logging as transformers_logging
 import generate_label_mapping
+from text_store import TextStore
+from token_cache import load_or_build_token_cache, dataset_fingerprint, tokenizer_fingerprint, TOKENIZE_BATCH_SIZE
+from error_window import build_error_window, parse_match_lines
+from checkpoint_util import CheckpointManager, rng_state, set_rng_state
 
 # Suppress warnings
 warnings.filterwarnings('ignore', category=FutureWarning)
@@ -39,10 +49,12 @@ here specifically, the learning rate starts at config["learning_rate"] and decre
 """
 
 
-LIST_OF_DATASETS = listdir("/home/q524745/bachelor_thesis/datasets")
+DATASETS_PATH = "/home/q524745/bachelor_thesis/datasets"
+LIST_OF_DATASETS = sorted(f for f in listdir(DATASETS_PATH) if f.endswith((".csv", ".parquet"))) if os.path.isdir(DATASETS_PATH) else []
 DIR = "datasets" 
 TRAIN_PERCENTAGE = 0.8
 TEST_PERCENTAGE = 0.2
+CSV_CHUNK_SIZE = 10000
 
 # random.shuffle(LIST_OF_DATASETS)
 
@@ -51,7 +63,69 @@ SPLIT_CUTOFF = int(len(LIST_OF_DATASETS) * TRAIN_PERCENTAGE)
 train_dataset_names  = LIST_OF_DATASETS[:SPLIT_CUTOFF]
 test_dataset_names = LIST_OF_DATASETS[SPLIT_CUTOFF:]
 
-tokenizer = RobertaTokenizer.from_pretrained("roberta-base")
+CUSTOM_TOKENIZER_DIR = "custom_tokenizer"
+
+############################################################# Tokenizer #####################################################
+
+def load_tokenizer(name="roberta-base", fast=True):
+    """
+    Returns the tokenizer, name 'custom' is the BPE of step_4_tokenizer.ipynb (custom_vocab.json and roberta_base_merges.txt in custom_tokenizer/).
+    fast=True uses the Rust implementation of the tokenizers library, which encodes a batch of texts in parallel
+    (set TOKENIZERS_PARALLELISM=false to turn that off), fast=False the pure Python RobertaTokenizer.
+    """
+    if name == "custom" and fast:
+        return RobertaTokenizerFast(tokenizer_object=custom_bpe(*load_custom_bpe()))
+    if name == "custom":
+        vocab, merges = load_custom_bpe()
+        tokenizer = RobertaTokenizer(vocab_file=os.path.join(CUSTOM_TOKENIZER_DIR, "custom_vocab.json"),
+                                     merges_file=os.path.join(CUSTOM_TOKENIZER_DIR, "roberta_base_merges.txt"))
+        # same merges as the fast tokenizer, so both return the same ids
+        tokenizer.bpe_ranks = dict(zip(merges, range(len(merges))))
+        return tokenizer
+    tokenizer_class = RobertaTokenizerFast if fast else RobertaTokenizer
+    return tokenizer_class.from_pretrained(name)
+
+
+def load_custom_bpe(tokenizer_dir=CUSTOM_TOKENIZER_DIR):
+    """
+    Returns (vocab, merges) of the custom tokenizer. roberta_base_merges.txt contains all merges of roberta-base,
+    only the merges whose parts and result are in the custom vocabulary are used (like in step_4_tokenizer.ipynb).
+    """
+    with open(os.path.join(tokenizer_dir, "custom_vocab.json"), "r", encoding="utf-8") as file:
+        vocab = json.load(file)
+    merges = []
+    with open(os.path.join(tokenizer_dir, "roberta_base_merges.txt"), "r", encoding="utf-8") as file:
+        for line in file.read().split("\n"):
+            if not line or line.startswith("#version"):
+                continue
+            first, second = line.split()
+            if first in vocab and second in vocab and first + second in vocab:
+                merges.append((first, second))
+    return vocab, merges
+
+
+def custom_bpe(vocab, merges):
+    """
+    Byte-level BPE of the tokenizers library (Rust) for the custom vocabulary.
+    The custom ids have gaps (roberta-base ids are kept, new tokens start after them), the gaps are filled with
+    placeholder tokens that no merge can produce. Otherwise the library complains about every gap whenever the
+    tokenizer is copied or sent to a DataLoader worker.
+    """
+    used_ids = set(vocab.values())
+    vocab = dict(vocab)
+    vocab.update({f"<unused_{idx}>": idx for idx in range(max(used_ids) + 1) if idx not in used_ids})
+    backend = Tokenizer(BPE(vocab, merges, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    backend.post_processor = processors.RobertaProcessing(("</s>", vocab["</s>"]), ("<s>", vocab["<s>"]))
+    return backend
+
+
+def tokenizer_vocab_size(tokenizer):
+    """
+    Size the embedding of the model needs, the ids of the custom vocabulary have gaps (len(tokenizer) is too small).
+    """
+    return max(tokenizer.get_vocab().values()) + 1
 
 ############################################################# Label Mapping #####################################################
 
@@ -62,147 +136,446 @@ def load_label_mapping(file_path="label_mapping.json"):
 
 ############################################################# Dataloader #####################################################
 
-def streaming_load_data_files (dataset_names, dir_path):
+def streaming_load_data_files (dataset_names, dir_path, columns=None):
+    """
+    Yields the examples of the given datasets, one CSV per log or Parquet shards of step 3.
+    Both are read in chunks and only the given columns (None = all) are read.
+    CSVs are read with pandas instead of datasets.load_dataset, which would shard itself again inside of DataLoader workers.
+    """
     for file_name in dataset_names:
         filepath = os.path.join(dir_path, file_name)
-        dataset = load_dataset("csv", data_files=filepath, split="train", streaming=True)
-        for example in dataset:
-            yield example
+        if file_name.endswith(".parquet"):
+            parquet_file = pq.ParquetFile(filepath)
+            # older shards may not have all columns (e.g. match_lines)
+            available = None if columns is None else [c for c in columns if c in parquet_file.schema_arrow.names]
+            for batch in parquet_file.iter_batches(columns=available):
+                yield from batch.to_pylist()
+            continue
+        usecols = None if columns is None else lambda column: column in columns
+        for chunk in pd.read_csv(filepath, usecols=usecols, chunksize=CSV_CHUNK_SIZE, keep_default_na=False, dtype=str):
+            yield from chunk.to_dict("records")
 
 
 ############################################################# Custom Dataset #####################################################
-class CustomDataset(Dataset):
-    def __init__(self, dataset_stream, tokenizer, label_mapping, max_token_length=512):
-        self.data_stream = dataset_stream
+class CustomDataset(IterableDataset):
+    """
+    Streams the examples of the given datasets in batches, also from several DataLoader worker processes:
+    every worker reads its own share of the files (of the blocks of the token cache), in an order that is
+    shuffled per epoch with a fixed seed (set_epoch), so every run sees the same order.
+    With a text_store, the examples reference their log text by 'text_id' (step 3 with --dedupe_text).
+    Every (text, label) pair is then only tokenized and yielded once per epoch, weighted with the number of rows of the split it stands for.
+    With a token_cache, the pre-tokenized examples are read from the cache and the datasets are not touched at all.
+    With error_window, long log texts are cut to the lines around the lines step 3 matched ('match_lines') instead of
+    keeping the first max_token_length tokens (see error_window.py).
+    """
+    def __init__(self, dataset_names, dir_path, tokenizer, label_mapping, max_token_length=512, text_store=None, token_cache=None,
+                 batch_size=16, length_bucketing=False, bucket_size=50, shuffle=False, seed=666, columns=None, error_window=False):
+        self.dataset_names = dataset_names
+        self.error_window = error_window
+        self.dir_path = dir_path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.length_bucketing = length_bucketing
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
         self.tokenizer = tokenizer
         self.label_mapping = label_mapping
         self.max_token_length = max_token_length
-
-    def __iter__(self):
+        self.text_store = text_store
+        self.token_cache = token_cache
+        self._sample_counts = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def sample_counts(self):
+        """
+        {(text_id, main_category): number of rows} over the datasets of this split, the weights of the deduplicated texts.
+        Only text_id and main_category are read, once per dataset object (every DataLoader worker counts on its own).
+        """
+        if self._sample_counts is None:
+            counts = {}
+            for example in streaming_load_data_files(self.dataset_names, self.dir_path, ["text_id", "main_category"]):
+                key = (example.get("text_id"), example.get("main_category"))
+                counts[key] = counts.get(key, 0) + 1
+            self._sample_counts = counts
+        return self._sample_counts
+
+    def examples(self, dataset_names=None, text_shard=None):
+        """
+        Yields (log_line, label id, weight) of the examples in the given datasets (default: all).
+        text_shard = (worker id, number of workers) only yields the texts of the text store that belong to the worker.
+        """
+        seen = set()
+        sample_counts = self.sample_counts() if self.text_store is not None else None
         # Iterate over the streaming dataset and debug
-        for example in self.data_stream:
+        for example in streaming_load_data_files(self.dataset_names if dataset_names is None else dataset_names, self.dir_path, self.columns):
             try: 
-                log_line = example["log_line"]
                 main_category = example["main_category"]
+                if self.text_store is not None and "text_id" in example:
+                    text_id = example["text_id"]
+                    if text_shard is not None and int(text_id[:8], 16) % text_shard[1] != text_shard[0]:
+                        continue
+                    if (text_id, main_category) in seen:
+                        continue
+                    seen.add((text_id, main_category))
+                    log_line = self.text_store.get(text_id)
+                    weight = sample_counts[(text_id, main_category)]
+                else:
+                    log_line = example["log_line"]
+                    weight = 1
             except KeyError as e:
                 print(f"Missing field{e} in example: {example}")
                 continue
-            
-            # Proceed with tokenization if both fields are present
-            tokenized_input = self.tokenizer.encode_plus(
-                log_line,
-                add_special_tokens=True,
-                truncation=True,
-                padding="max_length",
-                max_length=self.max_token_length,
-                return_attention_mask=True,
-                return_tensors="pt"
-            )
-            # Check if 'main_category' exists, otherwise set a default
-            label = torch.tensor(self.label_mapping.get('main_category', 0), dtype=torch.long)  # Default to 0 if 'main_category' is missing
-
-            yield {
-                "input_ids": tokenized_input["input_ids"],
-                "attention_mask": tokenized_input["attention_mask"],
-                "labels": label.unsqueeze(0)
-            }
+            if log_line is None:
+                print(f"Text {example['text_id']} is missing in the text store")
+                continue
+            if self.error_window:
+                log_line = build_error_window(log_line, parse_match_lines(example.get("match_lines")), self.tokenizer, self.max_token_length)
+            # Default to 0 if 'main_category' is unknown
+            yield log_line, self.label_mapping.get(main_category, 0), weight
+
+    def tokenized_examples(self):
+        """
+        Yields (input ids, label id, weight) of the share of this worker without any padding, from the token cache if there is one.
+        """
+        worker_info = get_worker_info()
+        worker_id, n_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        rng = random.Random(self.seed + self.epoch)
+        if self.token_cache is not None:
+            # blocks of consecutive examples, so reading the memory-mapped cache stays mostly sequential
+            block_size = self.batch_size * self.bucket_size
+            blocks = list(range(0, len(self.token_cache), block_size))
+            if self.shuffle:
+                rng.shuffle(blocks)
+            for start in blocks[worker_id::n_workers]:
+                indices = list(range(start, min(start + block_size, len(self.token_cache))))
+                if self.shuffle:
+                    rng.shuffle(indices)
+                for index in indices:
+                    # the ids are a view into the memory-mapped token buffer
+                    yield self.token_cache[index]
+            return
+        dataset_names = list(self.dataset_names)
+        if self.shuffle:
+            rng.shuffle(dataset_names)
+        if self.text_store is not None:
+            # a text can be in the files of several workers, so the workers split the texts instead of the files
+            examples = self.examples(dataset_names, text_shard=(worker_id, n_workers))
+        else:
+            examples = self.examples(dataset_names[worker_id::n_workers])
+        # encode TOKENIZE_BATCH_SIZE texts at once, the fast tokenizer spreads a batch over all cores
+        while batch := list(itertools.islice(examples, TOKENIZE_BATCH_SIZE)):
+            log_lines, labels, weights = zip(*batch)
+            encoded = self.tokenizer(list(log_lines), add_special_tokens=True, truncation=True, max_length=self.max_token_length)
+            yield from zip(encoded["input_ids"], labels, weights)
+
+    def __iter__(self):
+        """
+        Yields batches of batch_size examples, padded to the longest example of the batch (see collate_batch).
+        With length bucketing, bucket_size batches worth of examples are sorted by length before they are cut
+        into batches, so examples of similar length end up together. The order of the batches is shuffled.
+        """
+        examples = self.tokenized_examples()
+        if not self.length_bucketing:
+            while batch := list(itertools.islice(examples, self.batch_size)):
+                yield collate_batch(batch, self.tokenizer.pad_token_id)
+            return
+        worker_info = get_worker_info()
+        rng = random.Random(self.seed + self.epoch * 1000 + (worker_info.id if worker_info is not None else 0))
+        while bucket := list(itertools.islice(examples, self.batch_size * self.bucket_size)):
+            bucket.sort(key=lambda example: len(example[0]))
+            batches = [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+            rng.shuffle(batches)
+            for batch in batches:
+                yield collate_batch(batch, self.tokenizer.pad_token_id)
+
+
+def collate_batch(examples, pad_token_id):
+    """
+    Collates [(input ids, label id, weight), ...] into a batch, padded to the longest example (not to max_token_length).
+    """
+    max_length = max(len(input_ids) for input_ids, _, _ in examples)
+    input_ids = np.full((len(examples), max_length), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(examples), max_length), dtype=np.int64)
+    for row, (ids, _, _) in enumerate(examples):
+        input_ids[row, :len(ids)] = ids
+        attention_mask[row, :len(ids)] = 1
+    return {
+        "input_ids": torch.from_numpy(input_ids),
+        "attention_mask": torch.from_numpy(attention_mask),
+        "labels": torch.tensor([label for _, label, _ in examples], dtype=torch.long),
+        "weights": torch.tensor([weight for _, _, weight in examples], dtype=torch.float)
+    }
 
 ############################################################# Custom Dataloader #####################################################
 class CustomDataModule:
-    def __init__(self, train_dataset_names, test_dataset_names, dir_path, batch_size=16, max_token_length=512, mapping_file="label_mapping.json"):
+    """
+    num_workers > 0 reads and tokenizes the datasets in DataLoader worker processes, each of them keeps prefetch_factor
+    batches ready. pin_memory speeds up copying the batches to the GPU.
+    """
+    def __init__(self, train_dataset_names, test_dataset_names, dir_path, batch_size=16, max_token_length=512, mapping_file="label_mapping.json", text_store_path=None, token_cache_dir=None, length_bucketing=False,
+                 num_workers=0, prefetch_factor=2, pin_memory=False, shuffle=True, seed=666, tokenizer_name="roberta-base", fast_tokenizer=True,
+                 error_window=False):
+        self.text_store = TextStore(text_store_path) if text_store_path else None
+        self.text_column = "text_id" if self.text_store is not None else "log_line"
+        self.token_cache_dir = token_cache_dir
         self.train_dataset_names = train_dataset_names
         self.test_dataset_names = test_dataset_names
         self.dir_path = dir_path
         self.batch_size = batch_size
+        self.length_bucketing = length_bucketing
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.pin_memory = pin_memory
+        self.shuffle = shuffle
+        self.seed = seed
+        self.error_window = error_window
         self.max_token_length = max_token_length
-        self.tokenizer = RobertaTokenizer.from_pretrained('roberta-base')
-        # try:
-        #     with open('label_mapping.json', "r"):
-        #         if os.path.exists(mapping_file):
-        #             self.label_mapping = load_label_mapping(mapping_file)
-        #         # else:
-        #             # self.label_mapping = generate_label_mapping.build_label_mapping(self.train_dataset_names, self.dir_path, save_path="mapping_file")
-        # except Exception:
-        #     print("'label-mapping' is empty. Fix it")
+        if num_workers > 0:
+            # every worker tokenizes on its own, parallelism inside the tokenizer would only oversubscribe the cores
+            os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        self.tokenizer = load_tokenizer(tokenizer_name, fast_tokenizer)
+        # label_mapping.json is kept up to date by step 3 (generate_label_mapping.py for older datasets)
+        self.label_mapping = load_label_mapping(mapping_file)
 
     def setup(self):
-        # Load streaming data
-        self.train_stream = streaming_load_data_files(self.train_dataset_names, self.dir_path)
-        self.test_stream = streaming_load_data_files(self.test_dataset_names, self.dir_path)
-
-        # Create datasets from streams
-        self.train_dataset = CustomDataset(self.train_stream, self.tokenizer,self.label_mapping, max_token_length=self.max_token_length)
-        self.test_dataset = CustomDataset(self.test_stream, self.tokenizer, self.label_mapping, max_token_length=self.max_token_length)
-
-    def train_dataloader(self):
-        return iter(self.train_dataset)
+        # Create the datasets, the files are streamed when they are iterated
+        columns = [self.text_column, "main_category"] + (["match_lines"] if self.error_window else [])
+        self.train_dataset = CustomDataset(self.train_dataset_names, self.dir_path, self.tokenizer, self.label_mapping, max_token_length=self.max_token_length, text_store=self.text_store,
+                                           batch_size=self.batch_size, length_bucketing=self.length_bucketing, shuffle=self.shuffle, seed=self.seed, columns=columns,
+                                           error_window=self.error_window)
+        # test batches stay in file order
+        self.test_dataset = CustomDataset(self.test_dataset_names, self.dir_path, self.tokenizer, self.label_mapping, max_token_length=self.max_token_length, text_store=self.text_store,
+                                          batch_size=self.batch_size, columns=columns, error_window=self.error_window)
+
+        # Pre-tokenized cache, only built (from the datasets) if there is none for the current tokenizer/max length/datasets
+        if self.token_cache_dir is not None:
+            for split, dataset, dataset_names in (("train", self.train_dataset, self.train_dataset_names), ("test", self.test_dataset, self.test_dataset_names)):
+                dataset.token_cache = load_or_build_token_cache(
+                    self.token_cache_dir, split, dataset.examples, self.tokenizer, self.max_token_length,
+                    self.label_mapping, dataset_names, self.dir_path, options={"error_window": self.error_window}
+                )
+
+    def _dataloader(self, dataset):
+        # the dataset already yields batches -> batch_size=None
+        if self.num_workers == 0:
+            return DataLoader(dataset, batch_size=None, pin_memory=self.pin_memory)
+        return DataLoader(dataset, batch_size=None, num_workers=self.num_workers, prefetch_factor=self.prefetch_factor, pin_memory=self.pin_memory)
+
+    def train_dataloader(self, epoch=0):
+        self.train_dataset.set_epoch(epoch)
+        return self._dataloader(self.train_dataset)
     
-    # def val_dataloader(self):
-    #     return self.test_dataset
+    def val_dataloader(self):
+        return self._dataloader(self.test_dataset)
 
     def test_dataloader(self):
-        return iter(self.test_dataset)
+        return self._dataloader(self.test_dataset)
 
 ############################################################# Classifier #####################################################
 
 class RoBERTaClassifier(nn.Module):                                                  # TODO All of this class
-    def __init__(self, n_labels):
+    """
+    model_name is the pretrained model (roberta-base, distilroberta-base, ...) or a directory with its config
+    (or a config object, e.g. the small random model of triage_service.py).
+    num_hidden_layers keeps only the first layers of the pretrained model, e.g. a 4 layer student for distillation (distill.py).
+    pretrained=False only builds the architecture (the weights come from a saved state dict).
+    """
+    def __init__(self, n_labels, vocab_size=None, model_name="roberta-base", pretrained=True, num_hidden_layers=None):
         super(RoBERTaClassifier, self).__init__()
         # steup roberta model
-        self.roberta = AutoModel.from_pretrained('roberta-base', return_dict=True)
+        overrides = {} if num_hidden_layers is None else {"num_hidden_layers": num_hidden_layers}
+        if pretrained:
+            self.roberta = AutoModel.from_pretrained(model_name, return_dict=True, **overrides)
+        else:
+            model_config = model_name if isinstance(model_name, PretrainedConfig) else AutoConfig.from_pretrained(model_name, **overrides)
+            self.roberta = AutoModel.from_config(model_config)
+        # the custom tokenizer has ids beyond the roberta-base vocabulary -> tokenizer_vocab_size(tokenizer)
+        if vocab_size is not None and vocab_size > self.roberta.config.vocab_size:
+            self.roberta.resize_token_embeddings(vocab_size)
         self.classifier = nn.Linear(self.roberta.config.hidden_size, n_labels)
         self.dropout = nn.Dropout(p=0.3)                    # TODO Why 0.3 --> Standard
-        self.loss_function = nn.CrossEntropyLoss()
+        self.loss_function = nn.CrossEntropyLoss(reduction="none")
 
-    def forward(self, input_ids, attention_mask, labels=None):
+    def forward(self, input_ids, attention_mask, labels=None, weights=None):
         outputs = self.roberta(input_ids=input_ids, attention_mask=attention_mask)
-        pooled_output = outputs.last_hidden_state.mean(dim=1)           # macht mean hier sinn? wenns ja ne categorical nummer is? maybe median notwendig?! Muss da noch drüber nachdenken
+        # mean over the real tokens only, the padding depends on the other examples in the batch
+        mask = attention_mask.unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+        pooled_output = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)           # macht mean hier sinn? wenns ja ne categorical nummer is? maybe median notwendig?! Muss da noch drüber nachdenken
         logits = self.classifier(self.dropout(pooled_output))
         loss = 0
         
         if labels is not None:
+            # weights = number of rows a deduplicated text stands for, weighted mean instead of repeating the text
             loss = self.loss_function(logits, labels)
+            loss = loss.mean() if weights is None else (loss * weights).sum() / weights.sum()
 
         return loss, logits
     
+def distillation_loss(logits, teacher_logits, labels, weights=None, temperature=2.0, alpha=0.5):
+    """
+    Loss of a student: alpha * KL divergence between the temperature-softened distributions of teacher and student
+    (times temperature², so the size of its gradients does not depend on the temperature) + (1 - alpha) * cross entropy
+    with the labels. weights as in RoBERTaClassifier.forward.
+    """
+    soft_loss = F.kl_div(F.log_softmax(logits.float() / temperature, dim=-1), F.log_softmax(teacher_logits.float() / temperature, dim=-1),
+                         reduction="none", log_target=True).sum(dim=-1) * temperature ** 2
+    hard_loss = F.cross_entropy(logits.float(), labels, reduction="none")
+    loss = alpha * soft_loss + (1 - alpha) * hard_loss
+    return loss.mean() if weights is None else (loss * weights).sum() / weights.sum()
+
 ############################################################# Training loop #####################################################
-def train_model(model, data_module, config):
+# settings a resumed run has to share with its checkpoint, otherwise the skipped batches are not the ones it trained on
+FINGERPRINT_CONFIG_KEYS = ("learning_rate", "weight_decay", "n_epochs", "batch_size", "accumulation_steps", "precision",
+                           "distillation_temperature", "distillation_alpha")
+
+
+def run_fingerprint(data_module, config, teacher=None):
+    """
+    Hash of the datasets of both splits (names, sizes, modification times), the settings of the data module that
+    decide the order of the batches, the tokenizer and the hyperparameters of the run.
+    """
+    parts = {
+        "train": dataset_fingerprint(data_module.train_dataset_names, data_module.dir_path),
+        "test": dataset_fingerprint(data_module.test_dataset_names, data_module.dir_path),
+        "data": [data_module.batch_size, data_module.max_token_length, data_module.length_bucketing, data_module.shuffle,
+                 data_module.seed, data_module.error_window, data_module.text_store is not None],
+        "tokenizer": tokenizer_fingerprint(data_module.tokenizer),
+        "config": {key: config.get(key) for key in FINGERPRINT_CONFIG_KEYS},
+        "distillation": teacher is not None
+    }
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def train_model(model, data_module, config, teacher=None):
+    """
+    Trains the model, with config["checkpoint_dir"] a checkpoint is saved every config["checkpoint_every"] steps and after
+    every epoch (the last config["keep_checkpoints"] are kept). If there are checkpoints, training resumes from the latest one,
+    unless it belongs to a finished run (a new run starts and the old checkpoints are removed). Resuming a run with other
+    datasets or settings (run_fingerprint) raises a ValueError.
+    config["accumulation_steps"] batches are accumulated into one optimizer step (effective batch size = batch_size * accumulation_steps).
+    config["precision"] "bf16" runs forward and backward pass under bfloat16 autocast (CPU or GPU), "fp16" under float16
+    autocast with loss scaling (GPU only), the weights and the optimizer stay in float32.
+    With a (trained, frozen) teacher, the model is trained as its student with distillation_loss
+    (config["distillation_temperature"], config["distillation_alpha"]), the validation loss stays the cross entropy.
+    """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model.to(device)
+    if teacher is not None:
+        teacher.to(device).eval()
+        for parameter in teacher.parameters():
+            parameter.requires_grad_(False)
+    accumulation_steps = config.get("accumulation_steps", 1)
+    precision = config.get("precision", "fp32")
+    if precision == "fp16" and device.type != "cuda":
+        raise ValueError("precision 'fp16' needs a GPU, use 'bf16' on the CPU")
+    autocast_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(precision)
+    # float16 gradients underflow without loss scaling, bfloat16 has the exponent range of float32 and needs none
+    scaler = torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+
+    def autocast():
+        return torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None)
 
     optimizer = optim.AdamW(model.parameters(), lr=config["learning_rate"],weight_decay=config["weight_decay"])
     scheduler = CosineAnnealingLR(optimizer, T_max=config["n_epochs"], eta_min=1e-6)                            # TODO Questions
 
-    for epoch in range(config["n_epochs"]):
+    checkpoints = CheckpointManager(config["checkpoint_dir"], config.get("keep_checkpoints", 3)) if config.get("checkpoint_dir") else None
+    checkpoint = checkpoints.load() if checkpoints is not None else None
+    fingerprint = run_fingerprint(data_module, config, teacher) if checkpoints is not None else None
+    if checkpoint is not None and checkpoint.get("complete"):
+        print(f"The run of the checkpoints in {checkpoints.directory} is finished, starting a new run")
+        checkpoints.clear()
+        checkpoint = None
+    if checkpoint is not None and checkpoint.get("fingerprint") != fingerprint:
+        raise ValueError(f"The checkpoints in {checkpoints.directory} belong to a run with other datasets or settings, "
+                         f"remove them or set another checkpoint_dir")
+    start_epoch, start_batch, step = 0, 0, 0
+    if checkpoint is not None:
+        print(f"Resuming at epoch {checkpoint['epoch'] + 1}, batch {checkpoint['batch']}")
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scheduler.load_state_dict(checkpoint["scheduler"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        start_epoch, start_batch, step = checkpoint["epoch"], checkpoint["batch"], checkpoint["step"]
+        if start_batch == 0:
+            set_rng_state(checkpoint["rng"])
+
+    def save_checkpoint(epoch, batch, train_loss, train_batch_counter):
+        checkpoints.save(step, {
+            "model": model.state_dict(), "optimizer": optimizer.state_dict(), "scheduler": scheduler.state_dict(),
+            "scaler": scaler.state_dict(), "rng": rng_state(), "epoch": epoch, "batch": batch, "step": step,
+            "train_loss": train_loss, "train_batch_counter": train_batch_counter, "fingerprint": fingerprint,
+            # the checkpoint after the last epoch marks the run as finished, the next run does not resume from it
+            "complete": epoch == config["n_epochs"] and batch == 0
+        })
+
+    for epoch in range(start_epoch, config["n_epochs"]):
         model.train()
         train_loss = 0
         train_batch_counter = 0
-        train_stream = data_module.train_dataloader()
+        train_stream = iter(data_module.train_dataloader(epoch))
+        skip = 0
+        if epoch == start_epoch and start_batch > 0:
+            # the order of the batches is fixed per epoch -> skip the batches that were already trained on
+            # (RNG state only now, creating the DataLoader iterator draws from it)
+            set_rng_state(checkpoint["rng"])
+            train_loss, train_batch_counter = checkpoint["train_loss"], checkpoint["train_batch_counter"]
+            skip = start_batch
+            train_stream = itertools.islice(train_stream, start_batch, None)
 
         # iterate over datastream
-        for example in train_stream:
-            optimizer.zero_grad()
-            """
-            In PyTorch, for every mini-batch during the training phase, we typically want to explicitly set the gradients to zero before starting
-            to do backpropagation (i.e., updating the Weights and biases) because PyTorch accumulates the gradients on subsequent backward passes.
-            This accumulating behavior is convenient while training RNNs or when we want to compute the gradient of the loss summed over multiple mini-batches.
-            So, the default action has been set to accumulate (i.e. sum) the gradients on every loss.backward() call.
-
-            Because of this, when you start your training loop, ideally you should zero out the gradients so that you do the parameter update correctly. Otherwise,
-            the gradient would be a combination of the old gradient, which you have already used to update your model parameters and the newly-computed gradient.
-            It would therefore point in some other direction than the intended direction towards the minimum (or maximum, in case of maximization objectives).
-            @ https://stackoverflow.com/questions/48001598/why-do-we-need-to-call-zero-grad-in-pytorch
-
-            """
-            batch = {k: v.to(device) for k, v, in example.items()}
+        batch_number = skip - 1
+        for batch_number, example in enumerate(train_stream, start=skip):
+            if batch_number % accumulation_steps == 0:
+                optimizer.zero_grad()
+                """
+                In PyTorch, for every mini-batch during the training phase, we typically want to explicitly set the gradients to zero before starting
+                to do backpropagation (i.e., updating the Weights and biases) because PyTorch accumulates the gradients on subsequent backward passes.
+                This accumulating behavior is convenient while training RNNs or when we want to compute the gradient of the loss summed over multiple mini-batches.
+                So, the default action has been set to accumulate (i.e. sum) the gradients on every loss.backward() call.
+
+                Because of this, when you start your training loop, ideally you should zero out the gradients so that you do the parameter update correctly. Otherwise,
+                the gradient would be a combination of the old gradient, which you have already used to update your model parameters and the newly-computed gradient.
+                It would therefore point in some other direction than the intended direction towards the minimum (or maximum, in case of maximization objectives).
+                @ https://stackoverflow.com/questions/48001598/why-do-we-need-to-call-zero-grad-in-pytorch
+
+                """
+            batch = {k: v.to(device, non_blocking=True) for k, v, in example.items()}
             
             #Forward pass
-            loss, logits = model(batch["input_ids"], batch["attention_mask"], batch["labels"])
-            loss.backward()
-            optimizer.step()
+            with autocast():
+                if teacher is None:
+                    loss, logits = model(batch["input_ids"], batch["attention_mask"], batch["labels"], batch.get("weights"))
+                else:
+                    with torch.no_grad():
+                        _, teacher_logits = teacher(batch["input_ids"], batch["attention_mask"])
+                    _, logits = model(batch["input_ids"], batch["attention_mask"])
+                    loss = distillation_loss(logits, teacher_logits, batch["labels"], batch.get("weights"),
+                                             config.get("distillation_temperature", 2.0), config.get("distillation_alpha", 0.5))
+            # mean over the accumulated batches
+            scaler.scale(loss / accumulation_steps).backward()
             train_loss += loss.item()
             train_batch_counter +=1
-
+            if (batch_number + 1) % accumulation_steps == 0:
+                scaler.step(optimizer)
+                scaler.update()
+                step += 1
+                if checkpoints is not None and step % config.get("checkpoint_every", 1000) == 0:
+                    save_checkpoint(epoch, batch_number + 1, train_loss, train_batch_counter)
+
+        # last batches of the epoch that did not fill a whole accumulation: their losses were divided by
+        # accumulation_steps -> rescale the gradients to the mean over the batches actually in the group
+        if (n_in_group := (batch_number + 1) % accumulation_steps) != 0:
+            with torch.no_grad():
+                for parameter in model.parameters():
+                    if parameter.grad is not None:
+                        parameter.grad.mul_(accumulation_steps / n_in_group)
+            scaler.step(optimizer)
+            scaler.update()
+            step += 1
 
         # Validation loop
         model.eval()
@@ -212,15 +585,21 @@ def train_model(model, data_module, config):
         with torch.no_grad():
             for example in val_stream:
                 batch = {k: v.to(device) for k, v, in example.items()}
-                loss, logits = model(batch["input_ids"], batch["attention_mask"], batch["labels"])
+                with autocast():
+                    loss, logits = model(batch["input_ids"], batch["attention_mask"], batch["labels"], batch.get("weights"))
                 val_loss += loss.item()
                 val_batch_counter += 1
 
-        train_loss = train_loss/train_batch_counter
-        val_loss = val_loss/val_batch_counter
+        train_loss = train_loss/max(train_batch_counter, 1)
+        val_loss = val_loss/max(val_batch_counter, 1)
 
         print(f"Epoch {epoch+1}, Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.4f}")
         scheduler.step()
+        if checkpoints is not None:
+            save_checkpoint(epoch + 1, 0, 0, 0)
+
+    if checkpoints is not None:
+        checkpoints.close()
     return model
 
 
@@ -229,7 +608,12 @@ config = {
     "learning_rate": 1e-5, 
     "weight_decay": 0.01,
     "n_epochs": 1,
-    "batch_size": 16
+    "batch_size": 16,
+    "checkpoint_dir": "checkpoints",
+    "checkpoint_every": 1000,       # steps
+    "keep_checkpoints": 3,
+    "accumulation_steps": 1,
+    "precision": "fp32"             # "bf16" on CPUs with AVX-512 BF16/AMX
 }
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+"""
+Long-running triage service: loads the patterns and the model once and classifies failed CI jobs over HTTP
+(TCP port or Unix socket), with the cascade of cascade.py (patterns first, the model for the rest).
+
+    POST /classify    body: a job output (JSON as downloaded in step 1, the failed tasks are extracted like in step 2),
+                      a log of step 2 ({"id", "stdout_lines"}), a list of them, {"logs": [...]} or plain stdout text
+                      -> {"results": [{"id", "prediction", "sub_category", "confidence", "tier", ...}, ...]}
+    GET  /stats       logs per tier, latency histograms, number and size of the micro-batches
+    GET  /health      "ok"
+
+Requests that arrive at the same time are grouped into micro-batches (MicroBatcher): a batch is classified as soon as it
+holds max_batch_size logs or max_latency_ms after its first request arrived, so the model gets full batches under load
+and a single request waits at most max_latency_ms longer.
+
+    $ python3 triage_service.py --model_dir model --port 8080
+    $ python3 triage_service.py --socket /tmp/triage.sock --random_model      (offline, small random model)
+    $ curl --unix-socket /tmp/triage.sock --data-binary @job_output.json http://localhost/classify
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import warnings
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cascade import CascadeClassifier, CASCADE_BATCH_SIZE
+from step_2_crop_logs import extract_error_info_from_stream
+from step_3_build_dataset import compile_patterns, load_pattern, PATTERNS
+
+MAX_LATENCY_MS = 20
+MAX_REQUEST_BYTES = 64 * 2 ** 20
+
+
+class MicroBatcher:
+    """
+    Collects the logs of concurrent requests and classifies them together in a single background thread.
+    submit blocks until the results of its logs are there.
+    """
+    def __init__(self, classify, max_batch_size=CASCADE_BATCH_SIZE, max_latency_ms=MAX_LATENCY_MS):
+        self.classify = classify
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.queue = queue.Queue()
+        self.n_batches = 0
+        self.n_logs = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, logs):
+        future = Future()
+        self.queue.put((logs, future))
+        return future.result()
+
+    def _collect(self, first):
+        """
+        Returns the requests of the next batch, None as request stops the batcher after this batch.
+        """
+        requests = [first]
+        n_logs = len(first[0])
+        deadline = time.monotonic() + self.max_latency
+        while n_logs < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.queue.put(None)
+                break
+            requests.append(request)
+            n_logs += len(request[0])
+        return requests
+
+    def _run(self):
+        while (first := self.queue.get()) is not None:
+            requests = self._collect(first)
+            logs = [log for request_logs, _ in requests for log in request_logs]
+            self.n_batches += 1
+            self.n_logs += len(logs)
+            try:
+                results = self.classify(logs)
+            except Exception:
+                # one bad request must not fail the others of the batch -> classify every request on its own
+                for request_logs, future in requests:
+                    try:
+                        future.set_result(self.classify(request_logs))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            start = 0
+            for request_logs, future in requests:
+                future.set_result(results[start:start + len(request_logs)])
+                start += len(request_logs)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def parse_request(body, content_type=""):
+    """
+    Returns the logs [{'id', 'stdout_lines'}, ...] of a request body (see the module docstring).
+    """
+    if not content_type.startswith("application/json"):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return [{"id": "", "stdout_lines": body.decode("utf-8", errors="replace").split("\n")}]
+    else:
+        data = json.loads(body)
+    if isinstance(data, dict) and "logs" in data:
+        data = data["logs"]
+    if isinstance(data, str):
+        return [{"id": "", "stdout_lines": data.split("\n")}]
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        raise ValueError("expected a job output, a log or a list of logs")
+    if data and isinstance(data[0], dict) and "plays" in data[0]:
+        # job output of step 1 -> the failed tasks, like step 2 does it
+        data = extract_error_info_from_stream(io.BytesIO(body))
+    logs = [log if isinstance(log, dict) else {"id": "", "stdout_lines": str(log).split("\n")} for log in data]
+    for log in logs:
+        stdout_lines = log.get("stdout_lines")
+        if not isinstance(stdout_lines, list) or not all(isinstance(line, str) for line in stdout_lines):
+            raise ValueError(f"'stdout_lines' of log {log.get('id', '')!r} is not a list of strings")
+    return logs
+
+
+class TriageHandler(BaseHTTPRequestHandler):
+    server_version = "TriageService/1.0"
+
+    def address_string(self):
+        # client_address of a Unix socket is not a (host, port) tuple
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, "ok")
+        elif self.path == "/stats":
+            batcher = self.server.batcher
+            self._send_json(200, {"tiers": self.server.cascade.stats.summary(), "batches": batcher.n_batches,
+                                  "mean_batch_size": batcher.n_logs / max(batcher.n_batches, 1)})
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_REQUEST_BYTES:
+            self._send_json(413, {"error": f"request larger than {MAX_REQUEST_BYTES} bytes"})
+            return
+        try:
+            logs = parse_request(self.rfile.read(length), self.headers.get("Content-Type", ""))
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            results = self.server.batcher.submit(logs) if logs else []
+        except Exception as e:
+            self._send_json(500, {"error": f"classification failed: {e}"})
+            return
+        for log, result in zip(logs, results):
+            result["id"] = log.get("id", "")
+        self._send_json(200, {"results": results})
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class TriageHTTPServer(ThreadingHTTPServer):
+    # bursts of concurrent requests are what the micro-batching is for, the default backlog of 5 would refuse them
+    request_queue_size = 128
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP client connection over a Unix socket (for scripts and tests that talk to the service).
+    """
+    def __init__(self, socket_path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def random_classifier(label_mapping_path="label_mapping.json", tokenizer_name="custom", hidden_size=64, num_hidden_layers=2, seed=666):
+    """
+    Small randomly initialized classifier with the tokenizer of custom_tokenizer/ (nothing is downloaded),
+    returns (model, tokenizer, label_mapping). Only for testing the service, its predictions are random.
+    """
+    import torch
+    from transformers import RobertaConfig
+    from train_util import RoBERTaClassifier, load_label_mapping, load_tokenizer, tokenizer_vocab_size
+
+    tokenizer = load_tokenizer(tokenizer_name)
+    label_mapping = load_label_mapping(label_mapping_path)
+    model_config = RobertaConfig(vocab_size=tokenizer_vocab_size(tokenizer), hidden_size=hidden_size, num_hidden_layers=num_hidden_layers,
+                                 num_attention_heads=2, intermediate_size=4 * hidden_size, max_position_embeddings=514,
+                                 pad_token_id=tokenizer.pad_token_id)
+    torch.manual_seed(seed)
+    return RoBERTaClassifier(n_labels=len(label_mapping), model_name=model_config, pretrained=False), tokenizer, label_mapping
+
+
+def create_server(cascade, port=None, socket_path=None, host="127.0.0.1", max_batch_size=CASCADE_BATCH_SIZE,
+                  max_latency_ms=MAX_LATENCY_MS, quiet=False):
+    """
+    Returns the HTTP server (Unix socket if socket_path is given, else TCP host:port), start it with serve_forever().
+    """
+    server = UnixHTTPServer(socket_path, TriageHandler) if socket_path else TriageHTTPServer((host, port), TriageHandler)
+    server.cascade = cascade
+    server.batcher = MicroBatcher(cascade.classify, max_batch_size, max_latency_ms)
+    server.quiet = quiet
+    return server
+
+
+def parse_input_arguments():
+    parser = argparse.ArgumentParser(description="Serves the classification of failed CI jobs over HTTP or a Unix socket")
+    parser.add_argument("--port", type=int, default=8080, help="TCP port (if no --socket is given)")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--socket", default=None, help="Path of a Unix socket to listen on instead of a TCP port")
+    parser.add_argument("--patterns", default=PATTERNS, help="Patterns file")
+    parser.add_argument("--model_dir", default=None, help="Directory of the model saved by train.py (none: patterns only)")
+    parser.add_argument("--quantized", action="store_true", help="Use the int8 model of quantize_model.py (CPU)")
+    parser.add_argument("--random_model", action="store_true", help="Small random model with custom_tokenizer/ (offline testing)")
+    parser.add_argument("--max_batch_size", type=int, default=CASCADE_BATCH_SIZE, help="Logs per micro-batch")
+    parser.add_argument("--max_latency_ms", type=float, default=MAX_LATENCY_MS, help="Longest time a request waits for its batch to fill")
+    parser.add_argument("--max_token_length", type=int, default=512, help="Maximum number of tokens per log")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of torch (default: torch default)")
+    parser.add_argument("--error_window", action="store_true", help="Give the model the last lines of long logs instead of the first")
+    parser.add_argument("--quiet", action="store_true", help="Do not log every request")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configuration = parse_input_arguments()
+    warnings.filterwarnings('ignore', category=FutureWarning)
+    matcher = compile_patterns(load_pattern(configuration.patterns))
+    engine = None
+    if configuration.model_dir is not None or configuration.random_model:
+        import inference_util
+        if configuration.random_model:
+            model, tokenizer, label_mapping = random_classifier()
+        else:
+            model, tokenizer, label_mapping = inference_util.load_classifier(configuration.model_dir, quantized=configuration.quantized)
+        engine = inference_util.InferenceEngine(model, tokenizer, label_mapping, batch_size=configuration.max_batch_size,
+                                                max_token_length=configuration.max_token_length, num_threads=configuration.num_threads,
+                                                error_window=configuration.error_window,
+                                                device="cpu" if configuration.quantized else None)
+    cascade = CascadeClassifier(matcher, engine, configuration.max_batch_size)
+    server = create_server(cascade, configuration.port, configuration.socket, configuration.host, configuration.max_batch_size,
+                           configuration.max_latency_ms, configuration.quiet)
+    print(f"Listening on {configuration.socket or f'{configuration.host}:{configuration.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()